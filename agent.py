@@ -1,30 +1,97 @@
 # agent - definitions of the surrounding agents - Licensed under AGPLv3 or later
 
-import json
+import asyncio
+import hashlib
 import os
+import re
 import sys
+import time
 import traceback
 from enum import Enum
 from textwrap import dedent
+from typing import Awaitable, Callable
 
 from agno.agent import Agent, RunResponse
 from pydantic import BaseModel, Field
 
-from common import AGENT_CONFIG, ProgressLogger, StdLogger, data_dir
-from weekly_picks import UrlList, WeeklyPick, list_news, order_news, write_weekly
-from weekly_picks import set_logger as set_wp_logger
-
-agent_logger = StdLogger()
-
+import users
+from articles import (
+    ARTICLE_REUSE_TIME,
+    deduplicate,
+    recent_articles,
+    stored_news,
+    store_articles,
+)
+from cache import Cache
+from common import (
+    RequestLogger,
+    agent_config,
+    data_dir,
+    lazy_agent,
+    normalize_url,
+    request_agent,
+)
+from extract import PROMPT_MAX_TOKENS, chunk_by_tokens, get_text_async
+from feeds import discover_feed, feed_news, score_stored
+from relevance import personal_relevance
+from resilience import ModelUnavailable, call_agent, model_available, stream_agent
+from scrape import scrape_cache
+from weekly_picks import (
+    NewsSummary,
+    Url,
+    UrlList,
+    WeeklyPick,
+    WeeklyPickList,
+    list_news,
+    order_news,
+    rank_news,
+    write_weekly,
+    write_weekly_batch,
+)
 
-def set_logger(logger: ProgressLogger):
-    global agent_logger
-    agent_logger = logger
-    set_wp_logger(logger)
+agent_logger = RequestLogger()
 
 
+# Files of previous versions, moved to the users database on startup
 FILE_PERSONALITIES = f"{data_dir}/personal_interests.json"
 FILE_WEEKLY_URLS = f"{data_dir}/weekly_urls.json"
+users.migrate_json(FILE_PERSONALITIES, FILE_WEEKLY_URLS)
+
+# Read the news from the RSS / Atom feeds of the weekly URLs, if they have one.
+USE_FEEDS = os.environ.get("USE_FEEDS", "1") != "0"
+# How many weekly URLs are scraped at the same time. 1 scrapes them one after the other.
+SCRAPE_CONCURRENCY = int(os.environ.get("SCRAPE_CONCURRENCY", "4"))
+# Maximum time in seconds for scraping one weekly URL.
+SCRAPE_TIMEOUT = float(os.environ.get("SCRAPE_TIMEOUT", "300"))
+# Same for writing the weekly picks from the ordered articles.
+WRITE_CONCURRENCY = int(os.environ.get("WRITE_CONCURRENCY", "4"))
+WRITE_TIMEOUT = float(os.environ.get("WRITE_TIMEOUT", "300"))
+# The articles are ranked locally by RANK_DT_WEIGHT * dt_relevance + RANK_PERSONAL_WEIGHT * personal_relevance.
+# Every article already taken from a site lowers the score of the others from the same site by RANK_SOURCE_PENALTY.
+RANK_DT_WEIGHT = float(os.environ.get("RANK_DT_WEIGHT", "1"))
+RANK_PERSONAL_WEIGHT = float(os.environ.get("RANK_PERSONAL_WEIGHT", "1"))
+RANK_SOURCE_PENALTY = float(os.environ.get("RANK_SOURCE_PENALTY", "2"))
+# If set, the order_news agent chooses the picks from a shortlist of ORDER_SHORTLIST times
+# the number of picks.
+ORDER_WITH_LLM = os.environ.get("ORDER_WITH_LLM", "0") != "0"
+ORDER_SHORTLIST = int(os.environ.get("ORDER_SHORTLIST", "2"))
+# Compute the personal_relevance locally from the personal interest, instead of using
+# the one of the model. Then the articles of a news site are shared by all users.
+LOCAL_RELEVANCE = os.environ.get("LOCAL_RELEVANCE", "1") != "0"
+# Weekly picks are written WRITE_BATCH_SIZE at a time by one model call, from the text
+# of the articles. 1 writes them one by one, letting the model fetch the articles.
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "5"))
+# Weekly picks are reused for PICK_CACHE_TIME seconds, and at most PICK_CACHE_MB are kept.
+PICK_CACHE_TIME = float(os.environ.get("PICK_CACHE_TIME", str(7 * 24 * 3600)))
+PICK_CACHE_MB = int(os.environ.get("PICK_CACHE_MB", "20"))
+
+pick_cache = Cache(
+    f"{data_dir}/picks.db",
+    ttl=PICK_CACHE_TIME,
+    keep=PICK_CACHE_TIME,
+    max_size=PICK_CACHE_MB * 1_000_000,
+    hot_size=1_000_000,
+)
 
 AGENT_PREPROMPT = dedent("""\
         You are a bot in a matrix channel and belong to the C4DT.
@@ -60,7 +127,7 @@ class AgCmd(Enum):
 
             - HELP - no arguments
             - PERSONAL_INTEREST - the new personal interest description the user gives
-            - WEEKLY - 1st mandatory argument is the number of weekly picks the user wants - per default it's 3 picks. Optional 2nd argument is specifications of subject in weekly picks
+            - WEEKLY - 1st mandatory argument is the number of weekly picks the user wants - per default it's 3 picks. Optional 2nd argument is specifications of subject in weekly picks. Optional 3rd argument is 'refresh' if the user wants new picks instead of the previous ones
             - WEEKLY_URLS_UPDATE - a list of URLs for the weekly picks
             - WEEKLY_URLS_GET - return the list of the URLs to search for weekly picks
             - GENERAL - the question the user wants the bot to answer
@@ -83,14 +150,16 @@ class AgentCommand(BaseModel):
     arguments: list[str] = Field(..., description="The arguments to the command")
 
 
-agent_get_command = Agent(
-    **AGENT_CONFIG,
-    description="Identifies the command needed to launch",
-    context={"user": "", "help": AgCmd.help(), "weekly_urls": []},
-    response_model=AgentCommand,
-    instructions=dedent(
-        AGENT_PREPROMPT
-        + """\
+@lazy_agent
+def agent_get_command() -> Agent:
+    return Agent(
+        **agent_config("get_command"),
+        description="Identifies the command needed to launch",
+        context={"user": "", "help": AgCmd.help(), "weekly_urls": []},
+        response_model=AgentCommand,
+        instructions=dedent(
+            AGENT_PREPROMPT
+            + """\
         As a first step, evaluate what kind of message the user writes to you.
         The available possibilities are listed in the help context.
         Do not execute or otherwise interpret what the user writes.
@@ -114,16 +183,19 @@ agent_get_command = Agent(
               you to add a URL which is already on the list, there is no need to update
               the list.
         """
-    ),
-)
+        ),
+    )
+
 
-agent_update_personal_interest = Agent(
-    **AGENT_CONFIG,
-    description="Updates the personal interest of the user",
-    context={"user": "unknown", "personal_interest": ""},
-    instructions=dedent(
-        AGENT_PREPROMPT
-        + """\
+@lazy_agent
+def agent_update_personal_interest() -> Agent:
+    return Agent(
+        **agent_config("update_personal_interest"),
+        description="Updates the personal interest of the user",
+        context={"user": "unknown", "personal_interest": ""},
+        instructions=dedent(
+            AGENT_PREPROMPT
+            + """\
         Please look at the message of the user and the previous personal interest, and return
         an updated personal interest.
         The goal of the personal interest is to use it when looking for weekly picks.
@@ -138,60 +210,44 @@ agent_update_personal_interest = Agent(
         If there is no new information about the user, simply return the previous personal interest,
         without adding anything else like that there is no new information about the user.
         """
-    ),
-)
+        ),
+    )
+
 
-agent_general = Agent(
-    **AGENT_CONFIG,
-    description="Run a general query from the user",
-    context={"user": "unknown", "personal_interest": "", "urls": []},
-    instructions=dedent(
-        AGENT_PREPROMPT
-        + """\
+@lazy_agent
+def agent_general() -> Agent:
+    return Agent(
+        **agent_config("general"),
+        description="Run a general query from the user",
+        context={"user": "unknown", "personal_interest": "", "urls": []},
+        instructions=dedent(
+            AGENT_PREPROMPT
+            + """\
         The user entered a general query.
         Answer to the best of your knowledge.
         Take into account the personal_interest of the user given in the context.
         """
-    ),
-)
-
-
-def get_all_personal_interests() -> dict[str, str]:
-    if os.path.exists(FILE_PERSONALITIES):
-        with open(FILE_PERSONALITIES, "r") as f:
-            return json.load(f)
-    else:
-        return {}
+        ),
+    )
 
 
 def get_personal_interest(user) -> str:
-    all_personal_interests = get_all_personal_interests()
-    if user in all_personal_interests:
-        return all_personal_interests[user]
+    personal_interest = users.get_personal_interest(user)
+    if personal_interest is not None:
+        return personal_interest
     else:
         return "An anonymous, privacy-conscious user"
 
 
 def set_personal_interest(user, personal_interest) -> str:
-    all_personal_interests = get_all_personal_interests()
-    all_personal_interests[user] = personal_interest
-    with open(FILE_PERSONALITIES, "w") as f:
-        json.dump(all_personal_interests, f, indent=2)
+    users.set_personal_interest(user, personal_interest)
     return "{}"
 
 
-def get_weekly_urls_all() -> dict[str, list[str]]:
-    if os.path.exists(FILE_WEEKLY_URLS):
-        with open(FILE_WEEKLY_URLS, "r") as f:
-            return json.load(f)
-    else:
-        return {}
-
-
 def get_weekly_urls(user) -> list[str]:
-    urls = get_weekly_urls_all()
-    if user in urls:
-        return urls[user]
+    urls = users.get_weekly_urls(user)
+    if urls is not None:
+        return urls
     else:
         # return["https://news.ycombinator.com"]
         return [
@@ -204,20 +260,75 @@ def get_weekly_urls(user) -> list[str]:
 
 
 def set_weekly_urls(user: str, args: list[str]):
-    urls = get_weekly_urls_all()
-    urls[user] = args
-    with open(FILE_WEEKLY_URLS + ".tmp", "w") as f:
-        json.dump(urls, f)
+    users.set_weekly_urls(user, args)
+
+
+HELP_PATTERN = re.compile(r"^(?:!?help|\?|commands)\s*[.!?]?$", re.I)
+WEEKLY_PATTERN = re.compile(
+    r"^(?:please\s+)?(?P<refresh>refresh\s+)?"
+    r"(?:(?:give|get|create|make|write)\s+(?:me\s+)?)?(?:my\s+)?"
+    r"(?P<number>\d+)?\s*weekly(?:\s+picks?)?(?:\s+for\s+me)?"
+    r"(?:\s+(?:on|about)\s+(?P<info>.+?))?\s*[.!]?$",
+    re.I,
+)
+URLS_GET_PATTERN = re.compile(
+    r"^(?:show|list|get|what are)?\s*(?:me\s+)?(?:my\s+|the\s+)?(?:weekly\s+)?urls\s*\??$",
+    re.I,
+)
+# Only URLs starting with http(s):// or www., as words like "node.js" or "README.md"
+# also look like domains.
+URL_PATTERN = re.compile(
+    r"^(?:https?://|www\.)(?:[\w-]+\.)*[\w-]+\.[a-z]{2,}(?::\d+)?(?:[/?#]\S*)?$", re.I
+)
+
+
+def parse_command_locally(user: str, message: str) -> AgentCommand | None:
+    """Recognizes the clear-cut commands without asking the model.
+    A message with only URLs adds them to the weekly URLs.
+    Returns None if the message needs to be interpreted by the model."""
+    text = message.strip()
+    if HELP_PATTERN.match(text):
+        return AgentCommand(command=AgCmd.HELP, arguments=[])
+
+    weekly = WEEKLY_PATTERN.match(text)
+    if weekly:
+        arguments = [weekly["number"] or "3"]
+        if weekly["info"] or weekly["refresh"]:
+            arguments.append(weekly["info"] or "")
+        if weekly["refresh"]:
+            arguments.append("refresh")
+        return AgentCommand(command=AgCmd.WEEKLY, arguments=arguments)
+
+    if URLS_GET_PATTERN.match(text):
+        return AgentCommand(command=AgCmd.WEEKLY_URLS_GET, arguments=[])
+
+    words = [w for w in re.split(r"[\s,;]+", re.sub(r"^urls:", "", text, flags=re.I)) if w]
+    if len(words) > 0 and all(URL_PATTERN.match(w) for w in words):
+        urls = [url for url in get_weekly_urls(user) if url != ""]
+        return AgentCommand(
+            command=AgCmd.WEEKLY_URLS_UPDATE,
+            arguments=urls + [w for w in dict.fromkeys(words) if w not in urls],
+        )
 
-    # In case the dump failed for some reason.
-    os.rename(FILE_WEEKLY_URLS + ".tmp", FILE_WEEKLY_URLS)
+    return None
 
 
 async def get_command(user: str, message: str) -> AgentCommand:
-    await agent_logger.log("Parsing command")
-    agent_get_command.context["user"] = user
-    agent_get_command.context["weekly_urls"] = get_weekly_urls(user)
-    reply: RunResponse = await agent_get_command.arun(message)
+    local = parse_command_locally(user, message)
+    if local is not None:
+        await agent_logger.debug(f"Found command {local.command} without the model")
+        return local
+
+    await agent_logger.log("Parsing command with the model")
+    get_command_agent = request_agent(
+        agent_get_command(),
+        context={
+            **agent_get_command().context,
+            "user": user,
+            "weekly_urls": get_weekly_urls(user),
+        },
+    )
+    reply: RunResponse = await call_agent("get_command", get_command_agent, message)
     if isinstance(reply.content, AgentCommand):
         await agent_logger.debug(f"Found command {reply.content.command}")
         return reply.content
@@ -225,92 +336,452 @@ async def get_command(user: str, message: str) -> AgentCommand:
         raise Exception("Couldn't interpret command")
 
 
+async def scrape_source(
+    url: str, user: str, context: dict, refresh: bool, semaphore: asyncio.Semaphore
+) -> list[NewsSummary]:
+    """Scrapes one weekly URL with its own copy of list_news, so every source
+    gets its own news_list.
+    If the timeout hits, the articles found so far are kept.
+    Without additional info or refresh, recently scored articles of the URL are reused,
+    and recently stored articles not yet scored for the user, e.g., from the pre-crawl,
+    are only scored. With LOCAL_RELEVANCE, all recently stored articles are reused.
+    If the URL has a feed, only the new articles of the feed are scored, and the
+    URL is only scraped if this fails."""
+    async with semaphore:
+        if context["info"] == "" and not refresh and LOCAL_RELEVANCE:
+            stored = stored_news(url, time.time() - ARTICLE_REUSE_TIME)
+            if len(stored) > 0:
+                await agent_logger.debug(f"Reusing {len(stored)} articles from {url}")
+                return stored
+        elif context["info"] == "" and not refresh:
+            recent = recent_articles(url, user)
+            if recent is not None:
+                await agent_logger.debug(f"Reusing {len(recent)} articles from {url}")
+                return recent
+            try:
+                stored = await score_stored(
+                    url, user, context, time.time() - ARTICLE_REUSE_TIME
+                )
+                if stored is not None:
+                    return stored
+            except Exception as e:
+                await agent_logger.error(f"Couldn't score the stored articles of {url}: {e}")
+
+        feed_url = None
+        if USE_FEEDS:
+            try:
+                feed_url = await discover_feed(url)
+            except Exception as e:
+                await agent_logger.error(f"Couldn't look for a feed on {url}: {e}")
+        if feed_url is not None:
+            await agent_logger.debug(f"Reading the feed {feed_url} of {url}")
+            try:
+                return await asyncio.wait_for(
+                    feed_news(url, feed_url, user, context), SCRAPE_TIMEOUT
+                )
+            except Exception as e:
+                await agent_logger.error(f"Couldn't use the feed of {url}: {e!r}")
+
+        source_news = request_agent(
+            list_news(), session_state={"news_list": []}, context=dict(context)
+        )
+        await agent_logger.debug(f"Scraping {url} for articles")
+        try:
+            await asyncio.wait_for(
+                call_agent("list_news", source_news, url), SCRAPE_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            await agent_logger.error(f"Timeout after {SCRAPE_TIMEOUT}s scraping {url}")
+        except Exception as e:
+            await agent_logger.error(f"Couldn't scrape {url}: {e}")
+
+        news_list = source_news.session_state["news_list"]
+        # The personal_relevance depends on the info, so only store the general one.
+        if context["info"] == "":
+            news_list = await store_articles(url, user, news_list)
+        return news_list
+
+
+async def scrape_sources(
+    urls: list[str], user: str, context: dict, refresh: bool = False
+) -> list[NewsSummary]:
+    """Scrapes all weekly URLs with at most SCRAPE_CONCURRENCY of them at the same time,
+    and merges the news_lists in the order of the urls, without duplicate articles."""
+    semaphore = asyncio.Semaphore(max(1, SCRAPE_CONCURRENCY))
+    news_lists = await asyncio.gather(
+        *[scrape_source(url, user, context, refresh, semaphore) for url in urls]
+    )
+    return deduplicate([news for news_list in news_lists for news in news_list])
+
+
+def pick_key(article: Url | NewsSummary, personal_interest: str) -> str:
+    """The same article, with the same summary, for the same personal interest,
+    gives the same weekly pick."""
+    summary = article.summary if isinstance(article, NewsSummary) else ""
+    return "/".join(
+        [
+            normalize_url(article.url),
+            hashlib.sha256(summary.encode()).hexdigest(),
+            hashlib.sha256(personal_interest.encode()).hexdigest(),
+        ]
+    )
+
+
+def format_pick(wp: WeeklyPick) -> str:
+    return f'"{wp.description}" - {wp.url}'
+
+
+async def cached_pick(article: Url | NewsSummary, personal_interest: str) -> str | None:
+    """Returns the previous pick for the same article and personal interest, if any."""
+    found, wp = pick_cache.get("weekly_pick", pick_key(article, personal_interest))
+    if not found:
+        return None
+    await agent_logger.debug(f"Reusing the weekly pick for {article.url}")
+    return format_pick(WeeklyPick(**wp))
+
+
+async def write_pick(
+    article: Url | NewsSummary, personal_interest: str, semaphore: asyncio.Semaphore
+) -> str | None:
+    """Writes the weekly pick for one article with its own copy of write_weekly.
+    Returns None if the pick failed or timed out."""
+    async with semaphore:
+        writer = request_agent(
+            write_weekly(),
+            context={"personal_interest": personal_interest, "article": article},
+        )
+        await agent_logger.debug(f"Summarizing {article.url}")
+        try:
+            wp: RunResponse = await asyncio.wait_for(
+                call_agent("write_weekly", writer, article.url), WRITE_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            await agent_logger.error(
+                f"Timeout after {WRITE_TIMEOUT}s writing the pick for {article.url}"
+            )
+            return None
+        except Exception as e:
+            await agent_logger.error(f"Couldn't write the pick for {article.url}: {e}")
+            return None
+
+        if isinstance(wp.content, WeeklyPick):
+            pick_cache.set(
+                "weekly_pick",
+                pick_key(article, personal_interest),
+                wp.content.model_dump(),
+            )
+            return format_pick(wp.content)
+
+        await agent_logger.error(f"Oups - weekly pick failed: {wp.content}")
+        return None
+
+
+async def article_text(url: str) -> str:
+    """Returns the readable text of the article, or "" if it cannot be fetched."""
+    try:
+        return await get_text_async(url)
+    except Exception as e:
+        await agent_logger.debug(f"Couldn't fetch {url}, will use Firecrawl: {e}")
+        return ""
+
+
+async def write_batch(
+    articles: list[Url | NewsSummary],
+    texts: list[str],
+    personal_interest: str,
+    semaphore: asyncio.Semaphore,
+) -> list[str | None]:
+    """Writes the weekly picks for all articles with one call to write_weekly_batch.
+    Returns None for the articles without a valid pick in the reply."""
+    async with semaphore:
+        writer = request_agent(
+            write_weekly_batch(),
+            context={
+                "personal_interest": personal_interest,
+                "articles": [
+                    {
+                        "url": article.url,
+                        "summary": (
+                            article.summary if isinstance(article, NewsSummary) else ""
+                        ),
+                        "text": text,
+                    }
+                    for article, text in zip(articles, texts)
+                ],
+            },
+        )
+        await agent_logger.debug(f"Summarizing {len(articles)} articles at once")
+        try:
+            reply: RunResponse = await asyncio.wait_for(
+                call_agent("write_weekly_batch", writer, "follow the instructions"),
+                WRITE_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            await agent_logger.error(
+                f"Timeout after {WRITE_TIMEOUT}s writing {len(articles)} picks"
+            )
+            return [None] * len(articles)
+        except Exception as e:
+            await agent_logger.error(f"Couldn't write {len(articles)} picks: {e}")
+            return [None] * len(articles)
+
+    if not isinstance(reply.content, WeeklyPickList):
+        await agent_logger.error(f"Oups - weekly picks failed: {reply.content}")
+        return [None] * len(articles)
+
+    by_url = {normalize_url(wp.url): wp for wp in reply.content.weekly_picks}
+    takes: list[str | None] = []
+    for article in articles:
+        wp = by_url.get(normalize_url(article.url))
+        if wp is None or wp.description.strip() == "":
+            takes.append(None)
+            continue
+        wp = wp.model_copy(update={"url": article.url})
+        pick_cache.set(
+            "weekly_pick", pick_key(article, personal_interest), wp.model_dump()
+        )
+        takes.append(format_pick(wp))
+    return takes
+
+
+async def write_batches(
+    articles: list[Url | NewsSummary],
+    personal_interest: str,
+    semaphore: asyncio.Semaphore,
+) -> list[str | None]:
+    """Writes the weekly picks in batches of at most WRITE_BATCH_SIZE articles,
+    and of at most PROMPT_MAX_TOKENS.
+    Returns None for the articles which couldn't be fetched, or without a valid pick."""
+    texts = await asyncio.gather(*[article_text(article.url) for article in articles])
+    fetched = [i for i, text in enumerate(texts) if text != ""]
+    batches = [
+        chunk[start : start + WRITE_BATCH_SIZE]
+        for chunk in chunk_by_tokens(
+            [articles[i].model_dump_json() + texts[i] for i in fetched],
+            PROMPT_MAX_TOKENS,
+        )
+        for start in range(0, len(chunk), WRITE_BATCH_SIZE)
+    ]
+    results = await asyncio.gather(
+        *[
+            write_batch(
+                [articles[fetched[i]] for i in batch],
+                [texts[fetched[i]] for i in batch],
+                personal_interest,
+                semaphore,
+            )
+            for batch in batches
+        ]
+    )
+
+    takes: list[str | None] = [None] * len(articles)
+    for batch, result in zip(batches, results):
+        for i, take in zip(batch, result):
+            takes[fetched[i]] = take
+    return takes
+
+
+async def write_picks(
+    articles: list[Url | NewsSummary], personal_interest: str, refresh: bool = False
+) -> list[str]:
+    """Writes the weekly picks with at most WRITE_CONCURRENCY model calls at the same time.
+    Unless refresh is set, previous picks for the same article and personal interest
+    are reused.
+    The other articles are written in batches if WRITE_BATCH_SIZE > 1, and the ones
+    which fail in a batch are written one by one.
+    The picks keep the order of the articles, failed picks are skipped."""
+    semaphore = asyncio.Semaphore(max(1, WRITE_CONCURRENCY))
+    takes: list[str | None] = [None] * len(articles)
+    if not refresh:
+        takes = [await cached_pick(article, personal_interest) for article in articles]
+    missing = [i for i, take in enumerate(takes) if take is None]
+
+    if WRITE_BATCH_SIZE > 1 and len(missing) > 1:
+        batched = await write_batches(
+            [articles[i] for i in missing], personal_interest, semaphore
+        )
+        for i, take in zip(missing, batched):
+            takes[i] = take
+        missing = [i for i in missing if takes[i] is None]
+        if len(missing) > 0:
+            await agent_logger.debug(f"Writing {len(missing)} picks one by one")
+
+    singles = await asyncio.gather(
+        *[write_pick(articles[i], personal_interest, semaphore) for i in missing]
+    )
+    for i, take in zip(missing, singles):
+        takes[i] = take
+    await agent_logger.debug(
+        f"Weekly pick cache: {pick_cache.hits} hits, {pick_cache.misses} misses, "
+        f"Firecrawl cache: {scrape_cache.hits} hits, {scrape_cache.misses} misses"
+    )
+    return [take for take in takes if take is not None]
+
+
 async def get_weekly(user: str, args: list[str]) -> str:
     number_takes = (args + ["3"])[0]
     info = (args + ["", ""])[1]
+    refresh = (args + ["", "", ""])[2].lower() == "refresh"
 
     personal_interest = get_personal_interest(user)
-    list_news.session_state = {"news_list": []}
-    list_news.context = {"personal_interest": personal_interest, "info": info}
     urls = get_weekly_urls(user)
 
     await agent_logger.log(
         f"Getting a total of {number_takes} picks with info='{info}' from urls={urls}"
     )
 
-    for url in urls:
-        await agent_logger.debug(f"Scraping {url} for articles")
-        await list_news.arun(url)
-
-    await agent_logger.debug(
-        f"Got a total of {len(list_news.session_state['news_list'])} articles"
+    news_list = await scrape_sources(
+        urls, user, {"personal_interest": personal_interest, "info": info}, refresh
     )
 
+    await agent_logger.debug(f"Got a total of {len(news_list)} articles")
+    if LOCAL_RELEVANCE:
+        # Repeated, so the info weighs more than the personal interest.
+        news_list = personal_relevance(news_list, f"{personal_interest} {info} {info}")
+
     await agent_logger.log("Ordering articles by relevance")
-    order_news.context["news_list"] = list_news.session_state["news_list"]
-    order_news.context["number_takes"] = number_takes
-    ordered: RunResponse = await order_news.arun("follow the instructions")
+    try:
+        number = int(number_takes)
+    except ValueError:
+        number = 3
+    shortlist = number * ORDER_SHORTLIST if ORDER_WITH_LLM else number
+    ranked = rank_news(
+        news_list,
+        shortlist,
+        dt_weight=RANK_DT_WEIGHT,
+        personal_weight=RANK_PERSONAL_WEIGHT,
+        source_penalty=RANK_SOURCE_PENALTY,
+    )
+    articles: list[Url | NewsSummary] = ranked
 
-    if not isinstance(ordered.content, UrlList):
-        await agent_logger.panic(
-            "Oups - something went wrong with the content:", ordered.content
+    if ORDER_WITH_LLM:
+        orderer = request_agent(
+            order_news(), context={"news_list": ranked, "number_takes": number_takes}
+        )
+        ordered: RunResponse = await call_agent(
+            "order_news", orderer, "follow the instructions"
         )
-        raise Exception("Couldn't order articles")
 
-    await agent_logger.debug(f"Ordered list of URLs: {ordered.content.url_list}")
+        if not isinstance(ordered.content, UrlList):
+            await agent_logger.panic(
+                f"Oups - something went wrong with the content: {ordered.content}"
+            )
+            raise Exception("Couldn't order articles")
 
-    await agent_logger.log("Starting to create summary")
-    write_weekly.context["personal_interest"] = personal_interest
-    takes = []
-    for article in ordered.content.url_list:
-        await agent_logger.debug(f"Summarizing {article.url}")
-        write_weekly.context["article"] = article
-        wp: RunResponse = await write_weekly.arun(article.url)
-        if isinstance(wp.content, WeeklyPick):
-            take = f'"{wp.content.description}" - {wp.content.url}'
-            takes.append(take)
-        else:
-            await agent_logger.error("Oups - weekply pick failed:", wp.content)
+        by_url = {news.url: news for news in ranked}
+        articles = [by_url.get(url.url, url) for url in ordered.content.url_list]
 
-    return takes
+    await agent_logger.debug(
+        f"Ordered list of URLs: {[article.url for article in articles]}"
+    )
+
+    await agent_logger.log("Starting to create summary")
+    return await write_picks(articles, personal_interest, refresh)
 
 
 async def update_personal_interest(user: str, args: list[str]):
     await agent_logger.log("Updating personal interests")
-    agent_update_personal_interest.context = {
-        "user": user,
-        "personal_interest": get_personal_interest(user),
-    }
-    answer = await agent_update_personal_interest.arun(" ".join(args))
+    updater = request_agent(
+        agent_update_personal_interest(),
+        context={
+            "user": user,
+            "personal_interest": get_personal_interest(user),
+        },
+    )
+    answer = await call_agent("update_personal_interest", updater, " ".join(args))
     set_personal_interest(user, answer.content)
 
 
-async def general_query(user: str, args: list[str]):
-    agent_general.context = {
+# A cheap check whether a message tells something about what the user likes.
+PREFERENCE_PATTERN = re.compile(
+    r"\b(?:i|i'm|im|my|me|we|our)\b.*\b(?:like|love|prefer|enjoy|hate|dislike|"
+    r"interest|care|follow|focus|favou?rite|want|wish|rather|into|fan|bored|tired)",
+    re.I,
+)
+
+# The messages waiting to be merged into the personal interest, and the task doing it, per user.
+pending_interests: dict[str, list[str]] = {}
+interest_updates: dict[str, asyncio.Task] = {}
+
+
+def schedule_interest_update(user: str, args: list[str]) -> asyncio.Task:
+    """Updates the personal interest of the user in the background.
+    Messages arriving while an update runs are merged into one next update,
+    so there is never more than one update per user at the same time."""
+    pending_interests.setdefault(user, []).append(" ".join(args))
+    if user not in interest_updates:
+        interest_updates[user] = asyncio.create_task(run_interest_updates(user))
+    return interest_updates[user]
+
+
+async def run_interest_updates(user: str):
+    try:
+        while user in pending_interests:
+            messages = pending_interests.pop(user)
+            try:
+                await update_personal_interest(user, messages)
+            except Exception as e:
+                await agent_logger.error(f"Couldn't update the personal interest: {e}")
+    finally:
+        interest_updates.pop(user, None)
+
+
+async def general_query(
+    user: str,
+    args: list[str],
+    on_partial: Callable[[str], Awaitable[None]] | None = None,
+):
+    """If on_partial is given, the answer is streamed, and on_partial is called with
+    the answer so far whenever it grows.
+    If the model cannot stream, the answer is returned at once."""
+    context = {
         "user": user,
         "personal_interest": get_personal_interest(user),
         "urls": get_weekly_urls(user),
     }
     await agent_logger.log("Running generic query (without history!)")
-    answer = await agent_general.arun(" ".join(args))
+    # While the model of agent_general fails, call_agent answers with the fallback.
+    if on_partial is not None and model_available(agent_general().model):
+        streamed = ""
+
+        async def on_text(text: str):
+            nonlocal streamed
+            streamed = text
+            await on_partial(text)
+
+        try:
+            streamer = request_agent(agent_general(), context=context)
+            return await stream_agent("general_stream", streamer, on_text, " ".join(args))
+        except Exception as e:
+            if streamed != "":
+                raise ModelUnavailable(f"The answer stopped: {e}") from e
+            await agent_logger.debug(f"Couldn't stream the answer: {e}")
+
+    general = request_agent(agent_general(), context=context)
+    answer = await call_agent("general", general, " ".join(args))
     return answer.content
 
 
-async def answer_message(user: str, message: str) -> str:
-    set_logger(agent_logger)
+async def answer_message(
+    user: str,
+    message: str,
+    on_partial: Callable[[str], Awaitable[None]] | None = None,
+) -> str:
+    """With on_partial, the answers to general queries are streamed, see general_query."""
     try:
         cmd = await get_command(user, message)
         if cmd.command == AgCmd.GENERAL:
-            await update_personal_interest(user, cmd.arguments)
-            return await general_query(user, cmd.arguments)
+            if PREFERENCE_PATTERN.search(" ".join(cmd.arguments)):
+                schedule_interest_update(user, cmd.arguments)
+            return await general_query(user, cmd.arguments, on_partial)
 
         elif cmd.command == AgCmd.PERSONAL_INTEREST:
-            await update_personal_interest(user, cmd.arguments)
+            await schedule_interest_update(user, cmd.arguments)
             return f"Updated personal interest to: {get_personal_interest(user)}"
 
         elif cmd.command == AgCmd.WEEKLY:
-            if len(cmd.arguments) > 1:
-                await update_personal_interest(user, cmd.arguments[1:])
+            if len(cmd.arguments) > 1 and cmd.arguments[1] != "":
+                schedule_interest_update(user, cmd.arguments[1:2])
             return f"Articles for your weekly picks:\n\n{'\n\n'.join(await get_weekly(user, cmd.arguments))}"
 
         elif cmd.command == AgCmd.WEEKLY_URLS_UPDATE:
@@ -322,6 +793,10 @@ async def answer_message(user: str, message: str) -> str:
 
         return AgCmd.help()
 
+    except ModelUnavailable as e:
+        await agent_logger.error(e)
+        return "Sorry, the language model is not available right now, please try again in a few minutes."
+
     except Exception as e:
         tb_lines = traceback.format_exception(*sys.exc_info())
         await agent_logger.error(e)
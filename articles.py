@@ -0,0 +1,155 @@
+# articles - store of the articles found on the weekly URLs - Licensed under AGPLv3 or later
+
+import asyncio
+import os
+import time
+
+from peewee import CompositeKey, FloatField, Model, SqliteDatabase, TextField
+
+from common import canonical_url, data_dir, normalize_url
+from weekly_picks import NewsSummary
+
+# Articles of a weekly URL are reused for this many seconds before it is scraped again.
+ARTICLE_REUSE_TIME = float(os.environ.get("ARTICLE_REUSE_TIME", str(6 * 3600)))
+
+articles_db = SqliteDatabase(
+    f"{data_dir}/articles.db", pragmas={"journal_mode": "wal", "synchronous": "normal"}
+)
+
+
+class Article(Model):
+    canonical_url = TextField(primary_key=True)
+    # The URL as it was found first
+    url = TextField()
+    # The canonical URL of the weekly URL where the article has been found first
+    source = TextField(index=True)
+    summary = TextField()
+    dt_relevance = FloatField()
+    first_seen = FloatField()
+    last_seen = FloatField(index=True)
+
+    class Meta:
+        database = articles_db
+
+
+class Relevance(Model):
+    """The personal_relevance of an article for a given user."""
+
+    canonical_url = TextField()
+    user = TextField()
+    personal_relevance = FloatField()
+    time = FloatField()
+
+    class Meta:
+        database = articles_db
+        primary_key = CompositeKey("canonical_url", "user")
+
+
+articles_db.create_tables([Article, Relevance])
+
+
+def source_articles(
+    source: str, user: str, since: float
+) -> tuple[list[NewsSummary], list[Article]]:
+    """Returns the articles found on the source since the given time:
+    the ones already scored for the user, and the ones which aren't."""
+    articles = list(
+        Article.select().where(
+            (Article.source == normalize_url(source)) & (Article.last_seen > since)
+        )
+    )
+    relevances = {
+        r.canonical_url: r.personal_relevance
+        for r in Relevance.select().where(
+            (Relevance.user == user)
+            & (Relevance.canonical_url.in_([a.canonical_url for a in articles]))
+        )
+    }
+    scored = [
+        NewsSummary(
+            url=a.url,
+            summary=a.summary,
+            dt_relevance=a.dt_relevance,
+            personal_relevance=relevances[a.canonical_url],
+        )
+        for a in articles
+        if a.canonical_url in relevances
+    ]
+    unscored = [a for a in articles if a.canonical_url not in relevances]
+    return scored, unscored
+
+
+def stored_news(source: str, since: float) -> list[NewsSummary]:
+    """Returns the articles found on the source since the given time, for any user,
+    without personal_relevance."""
+    return [
+        NewsSummary(
+            url=a.url,
+            summary=a.summary,
+            dt_relevance=a.dt_relevance,
+            personal_relevance=0,
+        )
+        for a in Article.select().where(
+            (Article.source == normalize_url(source)) & (Article.last_seen > since)
+        )
+    ]
+
+
+def recent_articles(source: str, user: str) -> list[NewsSummary] | None:
+    """Returns the articles found on the source in the last ARTICLE_REUSE_TIME seconds,
+    if they have all been scored for this user. Else returns None."""
+    scored, unscored = source_articles(source, user, time.time() - ARTICLE_REUSE_TIME)
+    if len(scored) == 0 or len(unscored) > 0:
+        return None
+    return scored
+
+
+async def store_articles(
+    source: str, user: str, news_list: list[NewsSummary], store_relevance: bool = True
+) -> list[NewsSummary]:
+    """Stores the articles found on the source, and if store_relevance is set,
+    the personal_relevance for the user.
+    The canonical URL is only the key of the article: the articles are returned
+    with the URL it was first found with, so the same article always has the
+    same URL, and it is fetched as it was found."""
+    now = time.time()
+    urls = await asyncio.gather(*[canonical_url(news.url) for news in news_list])
+    stored = []
+    for url, news in zip(urls, news_list):
+        with articles_db.atomic():
+            article = Article.get_or_none(Article.canonical_url == url)
+            if article is None:
+                first_url = news.url
+                Article.create(
+                    canonical_url=url,
+                    url=news.url,
+                    source=normalize_url(source),
+                    summary=news.summary,
+                    dt_relevance=news.dt_relevance,
+                    first_seen=now,
+                    last_seen=now,
+                )
+            else:
+                first_url = article.url
+                Article.update(
+                    summary=news.summary, dt_relevance=news.dt_relevance, last_seen=now
+                ).where(Article.canonical_url == url).execute()
+            if store_relevance:
+                Relevance.replace(
+                    canonical_url=url,
+                    user=user,
+                    personal_relevance=news.personal_relevance,
+                    time=now,
+                ).execute()
+        stored.append(news.model_copy(update={"url": first_url}))
+    return stored
+
+
+def deduplicate(news_list: list[NewsSummary]) -> list[NewsSummary]:
+    """Keeps only one article per normalized URL, the one with the highest dt_relevance."""
+    best: dict[str, NewsSummary] = {}
+    for news in news_list:
+        url = normalize_url(news.url)
+        if url not in best or news.dt_relevance > best[url].dt_relevance:
+            best[url] = news
+    return list(best.values())
@@ -0,0 +1,542 @@
+# c4dt-bench - offline benchmark of the bot with a stand-in model - Licensed under AGPLv3 or later
+
+# Runs answer_message and get_weekly without API keys or network:
+# - a deterministic stand-in model replaces the models of all agents
+# - HTTP and Firecrawl answers come from a fixtures file, recorded with --record,
+#   or generated if the file doesn't exist
+# - the model, HTTP, and Firecrawl latencies are simulated
+# - with --model-errors and --model-stalls, some model calls fail or hang, and a
+#   reliable stand-in model is the fallback of resilience.py
+# The results are appended to a JSON-lines file, and compared with the previous run.
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, AsyncIterator
+
+parser = argparse.ArgumentParser(description="Offline benchmark of the C4DT bot")
+parser.add_argument("--users", type=int, default=10, help="concurrent users")
+parser.add_argument("--picks", type=int, default=3, help="weekly picks per request")
+parser.add_argument("--sites", type=int, default=4, help="news sites of generated fixtures")
+parser.add_argument("--model-latency", type=float, default=0.5, help="seconds per model call")
+parser.add_argument("--token-latency", type=float, default=0.002, help="seconds per output token")
+parser.add_argument("--model-errors", type=float, default=0, help="fraction of failing model calls")
+parser.add_argument("--model-stalls", type=float, default=0, help="fraction of hanging model calls")
+parser.add_argument("--http-latency", type=float, default=0.05, help="seconds per HTTP request")
+parser.add_argument("--firecrawl-latency", type=float, default=1.0, help="seconds per scrape")
+parser.add_argument("--fixtures", default=None, help="default: DATA_DIR/bench_fixtures.json")
+parser.add_argument("--results", default=None, help="default: DATA_DIR/bench_results.jsonl")
+parser.add_argument(
+    "--record",
+    action="store_true",
+    help="use the real model, HTTP, and Firecrawl, and record the HTTP and Firecrawl answers as fixtures",
+)
+args = parser.parse_args()
+
+# Everything the bot stores goes to a fresh directory, so every run starts cold.
+results_dir = os.environ.get("DATA_DIR", ".")
+fixtures_file = args.fixtures or f"{results_dir}/bench_fixtures.json"
+results_file = args.results or f"{results_dir}/bench_results.jsonl"
+os.makedirs(results_dir, exist_ok=True)
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="c4dt-bench-")
+if not args.record:
+    os.environ.setdefault("FIRECRAWL_API_KEY", "bench")
+    os.environ["PRECRAWL_INTERVAL"] = "0"
+if args.model_errors > 0 or args.model_stalls > 0:
+    # Stalled calls are abandoned soon, and slow ones hedged early.
+    os.environ.setdefault("LLM_TIMEOUT", str(10 * args.model_latency + 1))
+    os.environ.setdefault("LLM_RETRY_DELAY", str(args.model_latency))
+    os.environ.setdefault("HEDGE_PERCENTILE", "90")
+    os.environ.setdefault("HEDGE_MIN_CALLS", "5")
+
+# The start of the bot is measured: importing its modules, and creating its agents.
+started = time.monotonic()
+import httpx
+from agno.models.base import Model
+from agno.models.response import ModelResponse
+
+import common
+
+imports_time = time.monotonic() - started
+
+
+# Chooses the failing and hanging calls, the same ones in every run.
+chaos = random.Random(0)
+
+
+@dataclass
+class BenchModel(Model):
+    """A stand-in model which answers every agent of the bot with plausible,
+    deterministic replies, after a simulated latency."""
+
+    id: str = "bench"
+    name: str = "BenchModel"
+    provider: str = "Bench"
+    latency: float = 0.5
+    token_latency: float = 0.002
+    errors: float = 0
+    stalls: float = 0
+
+    async def ainvoke(self, messages, response_format=None, tools=None, tool_choice=None):
+        draw = chaos.random()
+        if draw < self.errors:
+            await asyncio.sleep(self.latency / 10)
+            raise RuntimeError("BenchModel: simulated provider error")
+        if draw < self.errors + self.stalls:
+            await asyncio.sleep(100 * self.latency)
+        content, tool_calls = reply_for(messages, tools or [])
+        prompt = sum(len(str(m.content or "")) for m in messages) // 4
+        output = len(content or "") // 4 + 20 * len(tool_calls)
+        await asyncio.sleep(self.latency + self.token_latency * output)
+        return ModelResponse(
+            role="assistant",
+            content=content,
+            tool_calls=tool_calls,
+            response_usage={"input_tokens": prompt, "output_tokens": output},
+        )
+
+    async def ainvoke_stream(
+        self, messages, response_format=None, tools=None, tool_choice=None
+    ) -> AsyncIterator[ModelResponse]:
+        content, _ = reply_for(messages, [])
+        await asyncio.sleep(self.latency)
+        for word in (content or "").split(" "):
+            await asyncio.sleep(self.token_latency * 2)
+            yield ModelResponse(role="assistant", content=word + " ")
+
+    def invoke(self, *args, **kwargs):
+        raise NotImplementedError("BenchModel is async only")
+
+    def invoke_stream(self, *args, **kwargs):
+        raise NotImplementedError("BenchModel is async only")
+
+    def parse_provider_response(self, response: ModelResponse, **kwargs) -> ModelResponse:
+        return response
+
+    def parse_provider_response_delta(self, response: ModelResponse) -> ModelResponse:
+        return response
+
+
+# The agents are created on first use, so the model has to be replaced before.
+if not args.record:
+    common.model = BenchModel(
+        latency=args.model_latency,
+        token_latency=args.token_latency,
+        errors=args.model_errors,
+        stalls=args.model_stalls,
+    )
+    common.MODEL_ROUTES.clear()
+
+started = time.monotonic()
+import agent
+import metrics
+import resilience
+import scrape
+import weekly_picks
+from agent import answer_message, get_weekly
+
+imports_time += time.monotonic() - started
+
+if not args.record and (args.model_errors > 0 or args.model_stalls > 0):
+    resilience.fallback = BenchModel(
+        id="bench-fallback",
+        provider="BenchFallback",
+        latency=args.model_latency,
+        token_latency=args.token_latency,
+    )
+
+started = time.monotonic()
+AGENTS = {
+    agent.agent_get_command().description: "get_command",
+    agent.agent_update_personal_interest().description: "update_personal_interest",
+    agent.agent_general().description: "general",
+    weekly_picks.list_news().description: "list_news",
+    weekly_picks.score_news().description: "score_news",
+    weekly_picks.order_news().description: "order_news",
+    weekly_picks.write_weekly().description: "write_weekly",
+    weekly_picks.write_weekly_batch().description: "write_weekly_batch",
+}
+agents_time = time.monotonic() - started
+URL_FIELD = re.compile(r"""url["']?\s*[:=]\s*["'](https?://[^"']+)["']""")
+MARKDOWN_LINK = re.compile(r"\]\((https?://[^)\s]+)\)")
+
+
+def score(url: str, salt: str) -> float:
+    return hashlib.sha256((salt + url).encode()).digest()[0] % 11
+
+
+def tool_call(name: str, **arguments) -> dict:
+    return {
+        "id": f"call_{hashlib.sha256((name + str(arguments)).encode()).hexdigest()[:8]}",
+        "type": "function",
+        "function": {"name": name, "arguments": json.dumps(arguments)},
+    }
+
+
+def reply_for(messages, tools) -> tuple[str | None, list[dict]]:
+    """Returns the content and the tool calls the agent expects."""
+    system = next((str(m.content) for m in messages if m.role == "system"), "")
+    prompt = next((str(m.content) for m in reversed(messages) if m.role == "user"), "")
+    tool_results = [str(m.content) for m in messages if m.role == "tool"]
+    called = {
+        call["function"]["name"]
+        for m in messages
+        if m.role == "assistant"
+        for call in m.tool_calls or []
+    }
+    name = next((name for desc, name in AGENTS.items() if desc in system), "general")
+    # The context is added to the prompt after the message.
+    message = prompt.split("<context>")[0].strip()
+    url = message.split()[-1] if message else ""
+
+    if name == "get_command":
+        return json.dumps({"command": "GENERAL", "arguments": [message]}), []
+    if name == "update_personal_interest":
+        return f"Likes digital trust, and {message[:200]}", []
+    if name == "general":
+        return " ".join(["This is a deterministic answer to the question."] * 10), []
+
+    if name == "list_news":
+        if "scrape_website" not in called:
+            return None, [tool_call("scrape_website", url=url)]
+        if "add_news" not in called:
+            links = [
+                link
+                for result in tool_results
+                for link in MARKDOWN_LINK.findall(result)
+                if link.rstrip("/") != url.rstrip("/")
+            ]
+            return None, [
+                tool_call(
+                    "add_news",
+                    news={
+                        "url": link,
+                        "summary": f"Summary of {link}",
+                        "dt_relevance": score(link, "dt"),
+                        "personal_relevance": score(link, system[-200:]),
+                    },
+                )
+                for link in list(dict.fromkeys(links))[:5]
+            ]
+        return "Added the news", []
+
+    if name == "score_news":
+        urls = list(dict.fromkeys(URL_FIELD.findall(system + prompt)))
+        news = [
+            {
+                "url": u,
+                "summary": f"Summary of {u}",
+                "dt_relevance": score(u, "dt"),
+                "personal_relevance": score(u, system[-200:]),
+            }
+            for u in urls
+        ]
+        return json.dumps({"news_list": news}), []
+
+    if name == "order_news":
+        urls = list(dict.fromkeys(URL_FIELD.findall(system + prompt)))
+        return json.dumps({"url_list": [{"url": u} for u in urls]}), []
+
+    if name == "write_weekly":
+        if "scrape_website" not in called:
+            return None, [tool_call("scrape_website", url=url)]
+        return json.dumps({"url": url, "description": f"A weekly pick about {url}. " * 8}), []
+
+    if name == "write_weekly_batch":
+        urls = list(dict.fromkeys(URL_FIELD.findall(system + prompt)))
+        picks = [{"url": u, "description": f"A weekly pick about {u}. " * 8} for u in urls]
+        return json.dumps({"weekly_picks": picks}), []
+
+    return "OK", []
+
+
+class Fixtures:
+    """HTTP and Firecrawl answers by URL, replayed with a simulated latency,
+    or recorded from the real services."""
+
+    def __init__(self, path: str, load: bool = True) -> None:
+        """Reads the fixtures from path if load is set and the file exists, else
+        starts empty. They are always saved to path."""
+        self.path = path
+        # The news sites used as weekly URLs
+        self.sites: list[str] = []
+        self.http: dict[str, dict] = {}
+        self.firecrawl: dict[str, dict] = {}
+        if load and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.sites, self.http, self.firecrawl = (
+                data["sites"],
+                data["http"],
+                data["firecrawl"],
+            )
+
+    def save(self) -> None:
+        with open(self.path, "w") as f:
+            json.dump(
+                {"sites": self.sites, "http": self.http, "firecrawl": self.firecrawl},
+                f,
+                indent=1,
+            )
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(args.http_latency)
+        recorded = self.http.get(str(request.url))
+        if recorded is None:
+            return httpx.Response(404, request=request)
+        return httpx.Response(
+            recorded["status"],
+            headers=recorded["headers"],
+            content=recorded["body"].encode(),
+            request=request,
+        )
+
+    async def record(self, request: httpx.Request) -> httpx.Response:
+        async with httpx.AsyncClient(follow_redirects=True) as client:
+            response = await client.send(request)
+            await response.aread()
+        self.http[str(request.url)] = {
+            "status": response.status_code,
+            "headers": {"content-type": response.headers.get("content-type", "text/html")},
+            "body": response.text,
+        }
+        return httpx.Response(
+            response.status_code,
+            headers=self.http[str(request.url)]["headers"],
+            content=response.content,
+            request=request,
+        )
+
+
+class FirecrawlReplay:
+    """Stands in for the FirecrawlApp of the ScrapeTools, see scrape.firecrawl_client."""
+
+    def __init__(self, fixtures: Fixtures, app: Any = None) -> None:
+        self.fixtures = fixtures
+        self.app = app
+
+    def scrape_url(self, url: str, **kwargs):
+        if self.app is not None:
+            result = self.app.scrape_url(url, **kwargs)
+            self.fixtures.firecrawl[url] = {
+                "markdown": result.markdown or "",
+                "metadata": result.metadata if isinstance(result.metadata, dict) else {},
+            }
+            return result
+        # Called in a thread, like the real Firecrawl.
+        time.sleep(args.firecrawl_latency)
+        recorded = self.fixtures.firecrawl.get(url) or self.fixtures.firecrawl.get(
+            url.rstrip("/")
+        )
+        if recorded is None:
+            raise Exception(f"No fixture for {url}")
+        return ScrapeResult(**recorded)
+
+
+class ScrapeResult:
+    def __init__(self, markdown: str, metadata: dict) -> None:
+        self.markdown = markdown
+        self.metadata = metadata
+
+    def model_dump_json(self) -> str:
+        return json.dumps({"markdown": self.markdown, "metadata": self.metadata})
+
+
+def generate_fixtures(fixtures: Fixtures, sites: int) -> None:
+    """News sites with 10 articles each. Every other site has an RSS feed."""
+    for s in range(sites):
+        site = f"https://site{s}.example"
+        fixtures.sites.append(site)
+        articles = [f"{site}/articles/{a}" for a in range(10)]
+        feed = s % 2 == 0
+        head = f'<link rel="alternate" type="application/rss+xml" href="{site}/feed">' if feed else ""
+        fixtures.http[site] = {
+            "status": 200,
+            "headers": {"content-type": "text/html"},
+            "body": f"<html><head>{head}</head><body>"
+            + "".join(f'<a href="{a}">Article {a}</a>' for a in articles)
+            + "</body></html>",
+        }
+        fixtures.firecrawl[site] = {
+            "markdown": "\n".join(f"- [Article about digital trust {a}]({a})" for a in articles),
+            "metadata": {"title": f"Site {s}"},
+        }
+        if feed:
+            fixtures.http[f"{site}/feed"] = {
+                "status": 200,
+                "headers": {"content-type": "application/rss+xml"},
+                "body": "<?xml version='1.0'?><rss><channel>"
+                + "".join(
+                    f"<item><guid>{a}</guid><link>{a}</link><title>Article {a}</title>"
+                    f"<description>About privacy and security, {a}</description></item>"
+                    for a in articles
+                )
+                + "</channel></rss>",
+            }
+        for a in articles:
+            text = f"This article at {a} talks about digital trust and how to fix it. " * 40
+            fixtures.http[a] = {
+                "status": 200,
+                "headers": {"content-type": "text/html"},
+                "body": f"<html><body><article><h1>{a}</h1><p>{text}</p></article></body></html>",
+            }
+            fixtures.firecrawl[a] = {"markdown": f"# {a}\n\n{text}", "metadata": {"title": a}}
+
+
+def install(fixtures: Fixtures) -> None:
+    handler = fixtures.record if args.record else fixtures.handle
+    common.http_client = httpx.AsyncClient(
+        transport=httpx.MockTransport(handler), follow_redirects=True
+    )
+    scrape.firecrawl_client = FirecrawlReplay(
+        fixtures, scrape.firecrawl_app() if args.record else None
+    )
+
+
+def startup() -> dict:
+    """The time to import the modules of the bot and to create all its agents."""
+    wall = imports_time + agents_time
+    print(f"startup: {wall:.3f}s, imports {imports_time:.3f}s, agents {agents_time:.3f}s")
+    return {
+        "scenario": "startup",
+        "requests": 1,
+        "wall": round(wall, 3),
+        "throughput": round(1 / wall, 3),
+        "peak_mb": 0,
+        "stages": {"imports": round(imports_time, 3), "agents": round(agents_time, 3)},
+    }
+
+
+async def scenario(name: str, requests: int, run) -> dict:
+    """Runs the scenario, and returns its wall time, throughput, peak memory, and
+    the statistics of its stages."""
+    metrics.stages.clear()
+    tracemalloc.reset_peak()
+    start = time.monotonic()
+    await run()
+    wall = time.monotonic() - start
+    _, peak = tracemalloc.get_traced_memory()
+    stages = {
+        f"{stage}/{model}" if model else stage: {
+            "calls": stats.calls,
+            "errors": stats.errors,
+            "cache_hits": stats.cache_hits,
+            "cache_misses": stats.cache_misses,
+            "tokens_saved": stats.tokens_saved,
+            "latency_sum": round(stats.latency.sum, 3),
+            "tokens_in": stats.tokens_in.sum,
+            "tokens_out": stats.tokens_out.sum,
+            "cost": round(stats.cost, 6),
+        }
+        for (stage, model), stats in sorted(metrics.stages.items())
+    }
+    result = {
+        "scenario": name,
+        "requests": requests,
+        "wall": round(wall, 3),
+        "throughput": round(requests / wall, 3),
+        "peak_mb": round(peak / 1_000_000, 2),
+        "stages": stages,
+    }
+    print(f"{name}: {result['wall']}s, {result['throughput']} req/s, {result['peak_mb']} MB")
+    return result
+
+
+def version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(results: list[dict]) -> None:
+    """Prints the change of the wall times against the previous run."""
+    if not os.path.exists(results_file):
+        return
+    with open(results_file) as f:
+        lines = f.read().splitlines()
+    if len(lines) == 0:
+        return
+    previous = json.loads(lines[-1])
+    before = {r["scenario"]: r for r in previous["results"]}
+    print(f"Compared to {previous['version']} from {previous['date']}:")
+    for result in results:
+        old = before.get(result["scenario"])
+        if old is not None and old["wall"] > 0:
+            change = (result["wall"] - old["wall"]) / old["wall"] * 100
+            print(f"  {result['scenario']}: {old['wall']}s -> {result['wall']}s ({change:+.0f}%)")
+
+
+async def bench() -> None:
+    # Recording starts over, with the default weekly URLs.
+    fixtures = Fixtures(fixtures_file, load=not args.record)
+    if args.record:
+        fixtures.sites = [url for url in agent.get_weekly_urls("") if url != ""]
+    elif len(fixtures.sites) == 0:
+        generate_fixtures(fixtures, args.sites)
+    sites = fixtures.sites[: args.sites]
+    install(fixtures)
+
+    users = [f"@bench{u}:example" for u in range(args.users)]
+    for user in users:
+        agent.set_weekly_urls(user, sites)
+        agent.set_personal_interest(user, f"User {user} likes privacy and security.")
+
+    results = [
+        startup(),
+        await scenario(
+            "answer_message",
+            1,
+            lambda: answer_message(users[0], "What is the capital of Switzerland?"),
+        ),
+        await scenario("get_weekly_cold", 1, lambda: get_weekly(users[0], [str(args.picks)])),
+        await scenario("get_weekly_warm", 1, lambda: get_weekly(users[0], [str(args.picks)])),
+        await scenario(
+            "concurrent_users",
+            len(users),
+            lambda: asyncio.gather(
+                *[answer_message(user, f"{args.picks} weekly picks") for user in users]
+            ),
+        ),
+    ]
+    await asyncio.gather(*agent.interest_updates.values(), return_exceptions=True)
+
+    if args.record:
+        fixtures.save()
+        print(f"Recorded {len(fixtures.http)} pages and {len(fixtures.firecrawl)} scrapes")
+        return
+    if not os.path.exists(fixtures_file):
+        fixtures.save()
+
+    compare(results)
+    with open(results_file, "a") as f:
+        f.write(
+            json.dumps(
+                {
+                    "version": version(),
+                    "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "args": vars(args),
+                    "results": results,
+                }
+            )
+            + "\n"
+        )
+    print(f"Results appended to {results_file}")
+
+
+tracemalloc.start()
+asyncio.run(bench())
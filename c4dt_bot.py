@@ -15,21 +15,37 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import time
+
+# The start of the bot is measured from here, see startup_report.
+started = time.monotonic()
+
+import asyncio
 import datetime
-from typing import Set
+from collections import defaultdict
+from typing import Awaitable, Callable, Set
 from dotenv import load_dotenv
 import os
+import markdown
 import nio
 import simplematrixbotlib as botlib
 from nio import RoomMessageText
 
-from agent import AgCmd, answer_message, set_logger
-from common import ALLOWED_USERS, ProgressLogger, data_dir
+from agent import AgCmd, answer_message
+from common import ALLOWED_USERS, ProgressLogger, data_dir, set_logger
+from metrics import dump_metrics, measure, serve_metrics, stage_stats, startup
+from precrawl import PRECRAWL_INTERVAL, run_precrawl
+
+startup["imports"] = time.monotonic() - started
 
 load_dotenv()
 matrix_home = os.environ.get("MATRIX_HOME")
 matrix_login = os.environ.get("MATRIX_LOGIN")
 matrix_pass = os.environ.get("MATRIX_PASS")
+# The statistics of the bot are written to DATA_DIR/metrics.json every
+# METRICS_DUMP_INTERVAL seconds, and served for Prometheus on localhost:METRICS_PORT.
+METRICS_DUMP_INTERVAL = float(os.environ.get("METRICS_DUMP_INTERVAL", "60"))
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
 
 if matrix_home == None or matrix_login == None or matrix_pass == None:
     print("Please export MATRIX_HOME, MATRIX_LOGIN, and MATRIX_PASS, and then run the script again")
@@ -47,6 +63,113 @@ creds = botlib.Creds(matrix_home, matrix_login, matrix_pass,
 bot = botlib.Bot(creds, config)
 PREFIX = '!'
 
+# Progress messages are sent to the room every LOG_FLUSH_INTERVAL seconds, all lines
+# in one message, and there are at least ROOM_SEND_INTERVAL seconds between two
+# messages to the same room.
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "2"))
+ROOM_SEND_INTERVAL = float(os.environ.get("ROOM_SEND_INTERVAL", "1"))
+
+# Kept open, and flushed together with the progress messages.
+log_file = open(f"{data_dir}/logger.log", "a", buffering=1 << 16)
+pending_lines: dict[str, list[str]] = defaultdict(list)
+send_locks: dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+last_sent: dict[str, float] = {}
+
+async def rate_limited(room_id: str, send: Callable[[], Awaitable]):
+    """Calls send once ROOM_SEND_INTERVAL seconds have passed since the last message
+    to this room."""
+    async with send_locks[room_id]:
+        wait = last_sent.get(room_id, 0) + ROOM_SEND_INTERVAL - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            with measure("matrix_send"):
+                return await send()
+        finally:
+            last_sent[room_id] = time.monotonic()
+
+async def send_message(room_id: str, message: str, markdown: bool = True):
+    if markdown:
+        await rate_limited(room_id, lambda: bot.api.send_markdown_message(room_id, message))
+    else:
+        await rate_limited(room_id, lambda: bot.api.send_text_message(room_id, message))
+
+async def flush_room(room_id: str):
+    """Sends the pending progress messages of the room as one message."""
+    lines = pending_lines.pop(room_id, [])
+    if len(lines) > 0:
+        await send_message(room_id, "\n".join(lines), markdown=False)
+
+async def flush_logs():
+    while True:
+        await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        log_file.flush()
+        results = await asyncio.gather(*[flush_room(room_id) for room_id in list(pending_lines)],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Couldn't send the progress messages: {result}")
+
+# Answers to general queries are streamed into one message, which is edited at most
+# every STREAM_EDIT_INTERVAL seconds.
+STREAM_ANSWERS = os.environ.get("STREAM_ANSWERS", "1") != "0"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "2"))
+
+def markdown_content(message: str) -> dict:
+    return {
+        "msgtype": "m.text",
+        "body": message,
+        "format": "org.matrix.custom.html",
+        "formatted_body": markdown.markdown(message, extensions=["fenced_code", "nl2br"]),
+    }
+
+class StreamedAnswer:
+    """Sends the first part of the answer as a message, and then replaces it
+    with the longer answers (m.replace).
+    If the message cannot be sent or edited, the whole answer is sent at the end."""
+
+    def __init__(self, room_id: str) -> None:
+        self.room_id = room_id
+        self.event_id = None
+        self.sent = ""
+        self.failed = False
+        self.last_edit = 0.0
+
+    async def send(self, content: dict):
+        return await rate_limited(self.room_id, lambda: bot.api.async_client.room_send(
+            self.room_id, "m.room.message", content, ignore_unverified_devices=True))
+
+    async def update(self, text: str) -> None:
+        if self.failed or time.monotonic() - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        try:
+            if self.event_id is None:
+                await flush_room(self.room_id)
+                response = await self.send(markdown_content(text))
+                if not isinstance(response, nio.RoomSendResponse):
+                    raise Exception(response)
+                self.event_id = response.event_id
+            else:
+                await self.send({
+                    **markdown_content(f"* {text}"),
+                    "m.new_content": markdown_content(text),
+                    "m.relates_to": {"rel_type": "m.replace", "event_id": self.event_id},
+                })
+            self.sent = text
+        except Exception as e:
+            print(f"Couldn't stream the answer to {self.room_id}: {e}")
+            self.failed = True
+        self.last_edit = time.monotonic()
+
+    async def finish(self, answer: str) -> None:
+        if self.event_id is not None and not self.failed:
+            if answer != self.sent:
+                self.last_edit = 0.0
+                await self.update(answer)
+            if not self.failed:
+                return
+        await send_message(self.room_id, answer)
+
 class MatrixLogger(ProgressLogger):
     def __init__(self, room, user) -> None:
         self.room = room
@@ -54,11 +177,9 @@ class MatrixLogger(ProgressLogger):
     
     async def msg(self, message: str) -> None:
         print(self.room, message)
-        with open(f"{data_dir}/logger.log", "a") as f:
-            f.write(datetime.datetime.now().strftime("%d-%b-%Y (%H:%M:%S.%f)") + 
-                    f" - {self.user}/{self.room} {message}\n")
-            
-        await bot.api.send_text_message(self.room, message)
+        log_file.write(datetime.datetime.now().strftime("%d-%b-%Y (%H:%M:%S.%f)") + 
+                       f" - {self.user}/{self.room} {message}\n")
+        pending_lines[self.room].append(message)
         
     async def log(self, message: str) -> None:
         await self.msg(f"* {message}")
@@ -76,25 +197,45 @@ class MatrixLogger(ProgressLogger):
         await self.msg(f"PANIC: {message}")
 
 joined = set()
+# Messages from different rooms are handled in parallel, but inside a room
+# they are answered one after the other.
+room_locks: dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+# Keep a reference to the running tasks, else they might be garbage collected.
+running = set()
 
 @bot.listener.on_message_event
 async def command(room, message: RoomMessageText):
     match = botlib.MessageMatch(room, message, bot, PREFIX)
     
     if match.is_not_from_this_bot():
-        set_logger(MatrixLogger(room.room_id, message.sender))
+        # Don't block the sync loop: every message gets its own task, and with it
+        # its own context for the logger.
+        task = asyncio.create_task(handle_message(room, message, match))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+async def handle_message(room, message: RoomMessageText, match: botlib.MessageMatch):
+    set_logger(MatrixLogger(room.room_id, message.sender))
+    async with room_locks[room.room_id]:
         if match.is_from_allowed_user():
             if message.sender in joined:
                 joined.remove(message.sender)
-                await bot.api.send_markdown_message(room.room_id, f"Welcome to the C4DT Chatbot!")
-                await bot.api.send_markdown_message(room.room_id, AgCmd.help())
-                await bot.api.send_markdown_message(room.room_id, 
-                                              f"You can find some examples of usage in the [README](https://github.com/c4dt/c4dt-bot?tab=readme-ov-file#tldr)")
+                await flush_room(room.room_id)
+                await send_message(room.room_id, f"Welcome to the C4DT Chatbot!")
+                await send_message(room.room_id, AgCmd.help())
+                await send_message(room.room_id, 
+                                   f"You can find some examples of usage in the [README](https://github.com/c4dt/c4dt-bot?tab=readme-ov-file#tldr)")
             else:
-                answer = await answer_message(message.sender, message.body)
-                await bot.api.send_markdown_message(room.room_id, answer)
+                streamed = StreamedAnswer(room.room_id)
+                try:
+                    answer = await answer_message(message.sender, message.body,
+                                                  streamed.update if STREAM_ANSWERS else None)
+                finally:
+                    # The progress messages go before the answer.
+                    await flush_room(room.room_id)
+                await streamed.finish(answer)
         else:
-            await bot.api.send_markdown_message(room.room_id, "You are not allowed to interact with the C4DT-Bot.")
+            await send_message(room.room_id, "You are not allowed to interact with the C4DT-Bot.")
 
 @bot.listener.on_custom_event(nio.RoomCreateEvent)
 async def created(room, event):
@@ -109,4 +250,59 @@ async def created(room, event):
     print(f"A user {event.sender} joined the room({room.room_id}) and is allowed: {event.sender in ALLOWED_USERS}.")
     print(f"{event}")
 
-bot.run()
+def startup_report() -> str:
+    """The time of every step of the start. The agents are only created when they
+    are first used, so they are usually not part of it."""
+    agents = stage_stats("agent_build").latency
+    startup["agents"] = agents.sum
+    return (
+        f"Started in {sum(startup.values()):.2f}s: imports {startup['imports']:.2f}s, "
+        f"login and crypto store {startup.get('login', 0):.2f}s, "
+        f"first sync {startup.get('first_sync', 0):.2f}s, "
+        f"{agents.count} agents created in {agents.sum:.2f}s"
+    )
+
+
+def timed_first_call(step: str, call):
+    """Returns the coroutine function call, recording the time of its first call
+    as the startup step."""
+
+    async def timed(*args, **kwargs):
+        if step in startup:
+            return await call(*args, **kwargs)
+        start = time.monotonic()
+        try:
+            return await call(*args, **kwargs)
+        finally:
+            startup[step] = time.monotonic() - start
+            if step == "first_sync":
+                print(startup_report())
+
+    return timed
+
+
+async def login():
+    """Logs in, which also loads the crypto store, and then measures the first sync."""
+    await login_api()
+    client = bot.api.async_client
+    client.sync = timed_first_call("first_sync", client.sync)
+
+
+login_api = timed_first_call("login", bot.api.login)
+bot.api.login = login
+
+
+async def main():
+    # The pre-crawl runs in the same event loop as the bot.
+    if PRECRAWL_INTERVAL > 0:
+        task = asyncio.create_task(run_precrawl())
+        running.add(task)
+    running.add(asyncio.create_task(flush_logs()))
+    if METRICS_DUMP_INTERVAL > 0:
+        running.add(asyncio.create_task(
+            dump_metrics(f"{data_dir}/metrics.json", METRICS_DUMP_INTERVAL)))
+    if METRICS_PORT > 0:
+        running.add(asyncio.create_task(serve_metrics(METRICS_PORT)))
+    await bot.main()
+
+asyncio.run(main())
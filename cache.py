@@ -0,0 +1,175 @@
+# cache - on-disk cache for fetched pages and other results - Licensed under AGPLv3 or later
+
+import json
+import time
+from typing import Any
+
+from cachetools import LRUCache
+from peewee import (
+    CompositeKey,
+    FloatField,
+    IntegerField,
+    Model,
+    SqliteDatabase,
+    TextField,
+    fn,
+)
+
+from metrics import record_cache
+
+
+class CacheEntry(Model):
+    namespace = TextField()
+    key = TextField()
+    # When the result has been stored
+    time = FloatField(index=True)
+    # Last time the result has been read, used to evict the least recently used entries
+    accessed = FloatField(index=True)
+    size = IntegerField()
+    result = TextField()
+    # Validators of the HTTP response, to revalidate expired entries
+    etag = TextField(null=True)
+    last_modified = TextField(null=True)
+
+    class Meta:
+        primary_key = CompositeKey("namespace", "key")
+        table_name = "cacheentry"
+
+
+class Cache:
+    """Results stored in an SQLite table, indexed by namespace and key.
+    Entries are fresh for ttl seconds. Expired entries are kept up to keep seconds,
+    so they can be revalidated, and if the total size goes above max_size,
+    the least recently used entries are evicted.
+    The most recently used results are also kept in memory, up to hot_size bytes.
+    Every cache has its own database file, so caches with different ttls don't
+    evict each other's entries."""
+
+    def __init__(
+        self, path: str, ttl: float, keep: float, max_size: int, hot_size: int
+    ) -> None:
+        self.ttl = ttl
+        self.keep = max(ttl, keep)
+        self.max_size = max_size
+        self.hot: LRUCache = LRUCache(maxsize=hot_size, getsizeof=lambda e: e[1])
+        # Last access of the results read from memory, written to the database
+        # before evicting, so reading from memory doesn't cost a write.
+        self.accessed: dict[tuple[str, str], float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.db = SqliteDatabase(
+            path, pragmas={"journal_mode": "wal", "synchronous": "normal"}
+        )
+
+        class Entry(CacheEntry):
+            class Meta:
+                database = self.db
+
+        self.Entry = Entry
+        # It's only a cache, so start over if the table is from an older version.
+        if self.db.table_exists(Entry._meta.table_name) and "etag" not in [
+            c.name for c in self.db.get_columns(Entry._meta.table_name)
+        ]:
+            self.db.drop_tables([Entry])
+        self.db.create_tables([Entry])
+
+    def get(self, namespace: str, key: str) -> tuple[bool, Any]:
+        """Returns (True, result) if there is a fresh result for this key, else (False, None)."""
+        now = time.time()
+        hot = self.hot.get((namespace, key))
+        if hot is not None and now - hot[0] < self.ttl:
+            self.accessed[(namespace, key)] = now
+            self.hits += 1
+            record_cache(namespace, True)
+            return True, hot[2]
+
+        entry = self.Entry.get_or_none(
+            (self.Entry.namespace == namespace) & (self.Entry.key == key)
+        )
+        if entry is None or now - entry.time >= self.ttl:
+            self.misses += 1
+            record_cache(namespace, False)
+            return False, None
+
+        self.Entry.update(accessed=now).where(
+            (self.Entry.namespace == namespace) & (self.Entry.key == key)
+        ).execute()
+        result = json.loads(entry.result)
+        self._set_hot(namespace, key, entry.time, entry.size, result)
+        self.hits += 1
+        record_cache(namespace, True)
+        return True, result
+
+    def get_entry(self, namespace: str, key: str) -> CacheEntry | None:
+        """Returns the entry for this key, even if it expired, with the result
+        already decoded."""
+        entry = self.Entry.get_or_none(
+            (self.Entry.namespace == namespace) & (self.Entry.key == key)
+        )
+        if entry is not None:
+            entry.result = json.loads(entry.result)
+        return entry
+
+    def set(
+        self,
+        namespace: str,
+        key: str,
+        result: Any,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ) -> None:
+        now = time.time()
+        data = json.dumps(result)
+        size = len(data)
+        with self.db.atomic():
+            self.Entry.replace(
+                namespace=namespace,
+                key=key,
+                time=now,
+                accessed=now,
+                size=size,
+                result=data,
+                etag=etag,
+                last_modified=last_modified,
+            ).execute()
+            self.evict(now)
+        self._set_hot(namespace, key, now, size, result)
+
+    def refresh(self, entry: CacheEntry) -> None:
+        """Marks an expired entry as fresh again, e.g., after a '304 Not Modified'."""
+        now = time.time()
+        self.Entry.update(time=now, accessed=now).where(
+            (self.Entry.namespace == entry.namespace) & (self.Entry.key == entry.key)
+        ).execute()
+        self._set_hot(entry.namespace, entry.key, now, entry.size, entry.result)
+
+    def evict(self, now: float) -> None:
+        """Removes entries older than keep, then the least recently used ones until
+        the cache fits in max_size."""
+        self._write_accessed()
+        self.Entry.delete().where(self.Entry.time <= now - self.keep).execute()
+
+        total = self.Entry.select(fn.COALESCE(fn.SUM(self.Entry.size), 0)).scalar()
+        if total <= self.max_size:
+            return
+        for entry in self.Entry.select(
+            self.Entry.namespace, self.Entry.key, self.Entry.size
+        ).order_by(self.Entry.accessed):
+            self.Entry.delete().where(
+                (self.Entry.namespace == entry.namespace) & (self.Entry.key == entry.key)
+            ).execute()
+            self.hot.pop((entry.namespace, entry.key), None)
+            total -= entry.size
+            if total <= self.max_size:
+                break
+
+    def _write_accessed(self) -> None:
+        accessed, self.accessed = self.accessed, {}
+        for (namespace, key), when in accessed.items():
+            self.Entry.update(accessed=fn.MAX(self.Entry.accessed, when)).where(
+                (self.Entry.namespace == namespace) & (self.Entry.key == key)
+            ).execute()
+
+    def _set_hot(self, namespace: str, key: str, stored: float, size: int, result: Any):
+        if size <= self.hot.maxsize:
+            self.hot[(namespace, key)] = (stored, size, result)
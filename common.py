@@ -1,15 +1,19 @@
+import asyncio
 import datetime
-import json
+import functools
+import importlib.util
 import os
 import time
+from contextvars import ContextVar
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import httpx
-from agno.models.anthropic import Claude
-from agno.models.lmstudio import LMStudio
-from agno.models.openai import OpenAIChat
-from agno.models.openai.like import OpenAILike
+from agno.agent import Agent
 from dotenv import load_dotenv
 
+from cache import Cache, CacheEntry
+from metrics import measure
+
 CACHE_TIME = 3600
 
 load_dotenv()
@@ -19,32 +23,137 @@ try:
 except:
     ""
 
-if os.environ.get("ANTHROPIC_API_KEY", "0") != "0":
-    print("Using Anthropic Claude Sonnet 4.5")
-    model = Claude(id="claude-4-5-sonnet")
-elif os.environ.get("OPENAI_API_KEY", "0") != "0":
-    print("Using OpenAI GPT-5-mini")
-    model = OpenAIChat(id="gpt-5-mini")
-elif os.environ.get("OPENAI_LIKE", "0") != "0":
-    print("Using OpenAI-like for AnythingLLM")
-    model = OpenAILike(
-        api_key=os.getenv("OPENAI_LIKE"),
-        id="c4dt",
-        base_url="http://localhost:3001/api/v1/openai",
-    )
-else:
-    print("Using LM Studio")
-    model = LMStudio()
+# Maximum size of the on-disk cache, and of the results kept in memory.
+CACHE_MAX_MB = int(os.environ.get("CACHE_MAX_MB", "200"))
+CACHE_HOT_MB = int(os.environ.get("CACHE_HOT_MB", "16"))
+# Expired pages are kept for CACHE_KEEP_TIME seconds, so they can be revalidated
+# with their ETag or Last-Modified.
+CACHE_KEEP_TIME = float(os.environ.get("CACHE_KEEP_TIME", str(7 * 24 * 3600)))
+# If set, expired pages are returned for up to CACHE_STALE_TIME seconds after they
+# expired, while they are revalidated in the background.
+CACHE_STALE_TIME = float(os.environ.get("CACHE_STALE_TIME", "0"))
+# Timeouts in seconds for all HTTP requests, and how many connections are kept
+# open in total and to every host.
+HTTP_TIMEOUT = httpx.Timeout(
+    float(os.environ.get("HTTP_READ_TIMEOUT", "30")),
+    connect=float(os.environ.get("HTTP_CONNECT_TIMEOUT", "10")),
+)
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_PER_HOST = int(os.environ.get("HTTP_MAX_PER_HOST", "6"))
+
+result_cache = Cache(
+    f"{data_dir}/cache.db",
+    ttl=CACHE_TIME,
+    keep=CACHE_KEEP_TIME,
+    max_size=CACHE_MAX_MB * 1_000_000,
+    hot_size=CACHE_HOT_MB * 1_000_000,
+)
+
+
+
+def make_model(spec: str):
+    """Returns the model for a spec "backend:id", with backend one of claude,
+    openai, openai-like, or lmstudio. For openai-like, the id can be followed by
+    "@base_url". Without id, the default model of the backend is used.
+    Only the SDK of the backend is imported, as they are slow to import."""
+    backend, _, id = spec.strip().partition(":")
+    backend = backend.lower()
+    if backend == "claude":
+        from agno.models.anthropic import Claude
+
+        return Claude(id=id or "claude-4-5-sonnet")
+    elif backend == "openai":
+        from agno.models.openai import OpenAIChat
+
+        return OpenAIChat(id=id or "gpt-5-mini")
+    elif backend == "openai-like":
+        from agno.models.openai.like import OpenAILike
+
+        id, _, base_url = id.partition("@")
+        return OpenAILike(
+            api_key=os.getenv("OPENAI_LIKE"),
+            id=id or "c4dt",
+            base_url=base_url or "http://localhost:3001/api/v1/openai",
+        )
+    elif backend == "lmstudio":
+        from agno.models.lmstudio import LMStudio
+
+        return LMStudio(id=id) if id else LMStudio()
+    raise ValueError(f"Unknown model backend in '{spec}'")
+
+
+# The model of all agents without their own. It is created by default_model
+# when the first agent is, unless it is set before, e.g., by the benchmark.
+model = None
 
-# Global configuration for all agents
+
+def default_model():
+    global model
+    if model is not None:
+        return model
+    if os.environ.get("MODEL", "") != "":
+        print(f"Using {os.environ['MODEL']}")
+        model = make_model(os.environ["MODEL"])
+    elif os.environ.get("ANTHROPIC_API_KEY", "0") != "0":
+        print("Using Anthropic Claude Sonnet 4.5")
+        model = make_model("claude")
+    elif os.environ.get("OPENAI_API_KEY", "0") != "0":
+        print("Using OpenAI GPT-5-mini")
+        model = make_model("openai")
+    elif os.environ.get("OPENAI_LIKE", "0") != "0":
+        print("Using OpenAI-like for AnythingLLM")
+        model = make_model("openai-like")
+    else:
+        print("Using LM Studio")
+        model = make_model("lmstudio")
+    return model
+
+
+# Global configuration for all agents, the model is added by agent_config.
 AGENT_CONFIG = {
-    "model": model,
     "use_json_mode": True,
     "add_state_in_messages": True,
     "add_context": True,
     # "show_tool_calls": True,
     # "debug_mode": True,
 }
+# Model of every agent which doesn't use the global one, from MODEL_<AGENT>,
+# e.g., MODEL_GET_COMMAND=lmstudio:qwen3-4b.
+MODEL_ROUTES = {
+    name[len("MODEL_") :].lower(): spec
+    for name, spec in os.environ.items()
+    if name.startswith("MODEL_") and spec.strip() != ""
+}
+# Models by spec, so agents routed to the same model share it.
+routed_models = {}
+
+
+def agent_config(route: str) -> dict:
+    """Returns AGENT_CONFIG for the agent of the route, with the model set in
+    MODEL_<ROUTE> if there is one, else the default model."""
+    spec = MODEL_ROUTES.get(route)
+    if spec is None:
+        return {**AGENT_CONFIG, "model": default_model()}
+    if spec not in routed_models:
+        print(f"Using {spec} for {route}")
+        routed_models[spec] = make_model(spec)
+    return {**AGENT_CONFIG, "model": routed_models[spec]}
+
+
+def lazy_agent(build):
+    """Decorator for the functions creating an agent: the agent is created on the
+    first call, and then reused. So the bot starts without creating the agents,
+    nor importing the models, and only does so for the agents it uses."""
+
+    @functools.cache
+    @functools.wraps(build)
+    def agent() -> Agent:
+        with measure("agent_build"):
+            return build()
+
+    return agent
+
+
 ALLOWED_USERS = set(os.environ.get("ALLOWED_USERS", "").split(","))
 
 
@@ -73,51 +182,266 @@ class StdLogger(ProgressLogger):
         print(message)
 
 
-def cache_to_file(func):
-    """Decorator to cache function results to a local file."""
-
-    def wrapper(*args):
-        cache_file = f"{data_dir}/{func.__name__}_cache.json"
-        # Load cache from file if it exists
-        if os.path.exists(cache_file):
-            with open(cache_file, "r") as f:
-                cache = json.load(f)
-        else:
-            cache = {}
-
-        # Check if result is already cached
-        key = str(args)
-        if key in cache:
-            if time.time() - cache[key]["time"] < CACHE_TIME:
-                print(f"Returning cache for {key}")
-                return cache[key]["result"]
-
-            print(f"Cache expired for {key}")
-
-        # Call the function and cache the result
-        result = func(*args)
-        cache[key] = {"time": time.time(), "result": result}
-        with open(cache_file, "w") as f:
-            json.dump(cache, f, indent=2)
-        return result
+current_logger: ContextVar[ProgressLogger] = ContextVar(
+    "current_logger", default=StdLogger()
+)
+
+
+def set_logger(logger: ProgressLogger):
+    """Sets the logger for the current request.
+    Every asyncio task works on its own copy of the context, so requests running
+    in different tasks don't see each other's logger."""
+    current_logger.set(logger)
+
+
+class RequestLogger(ProgressLogger):
+    """Forwards all messages to the logger set for the current request."""
 
-    return wrapper
+    async def msg(self, message: str) -> None:
+        await current_logger.get().msg(message)
+
+    async def log(self, message: str) -> None:
+        await current_logger.get().log(message)
 
+    async def debug(self, message: str) -> None:
+        await current_logger.get().debug(message)
+
+    async def trace(self, message: str) -> None:
+        await current_logger.get().trace(message)
 
-def get_response_cached(url: str) -> httpx.Response:
+    async def error(self, message: str) -> None:
+        await current_logger.get().error(message)
+
+    async def panic(self, message: str) -> None:
+        await current_logger.get().panic(message)
+
+
+def request_agent(template: Agent, **update) -> Agent:
+    """Returns a copy of the template agent to be used for one request only,
+    so concurrent requests don't share context or session_state.
+    The model is shared, as it keeps no state between calls and can reuse its connections."""
+    return template.deep_copy(update={"model": template.model, **update})
+
+
+def with_scheme(url: str) -> str:
     if not (url.startswith("https://") or url.startswith("http://")):
-        url = f"https://{url}"
+        return f"https://{url}"
+    return url
+
 
-    response = httpx.get(url)
-    response.raise_for_status()
+def get_response_cached(url: str, headers: dict[str, str] | None = None) -> httpx.Response:
+    with measure("http"):
+        response = httpx.get(with_scheme(url), headers=headers, timeout=HTTP_TIMEOUT)
+        if response.status_code != 304:
+            response.raise_for_status()
     return response
 
 
-@cache_to_file
+def validator_headers(entry: CacheEntry | None) -> dict[str, str]:
+    """Returns the headers to ask the server whether the cached page changed."""
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+    return headers
+
+
+def store_response(
+    name: str, key: str, entry: CacheEntry | None, response: httpx.Response, parse
+):
+    """Stores the parsed response with its validators.
+    A '304 Not Modified' only refreshes the cached entry."""
+    if response.status_code == 304 and entry is not None:
+        print(f"Revalidated cache for {key}")
+        result_cache.refresh(entry)
+        return entry.result
+
+    result = parse(response)
+    result_cache.set(
+        name,
+        key,
+        result,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
+    return result
+
+
+def get_revalidated(name: str, url: str, parse):
+    """Returns the cached result for the url if it is fresh.
+    Else the page is fetched, conditionally if the cache has validators for it."""
+    key = str((url,))
+    found, result = result_cache.get(name, key)
+    if found:
+        print(f"Returning cache for {key}")
+        return result
+
+    entry = result_cache.get_entry(name, key)
+    response = get_response_cached(url, validator_headers(entry))
+    return store_response(name, key, entry, response, parse)
+
+
+def page_text(response: httpx.Response) -> str:
+    return response.text[:200000]
+
+
+def page_json(response: httpx.Response):
+    return response.json()
+
+
 def get_url_cached(url: str) -> str:
-    return get_response_cached(url).text[:200000]
+    return get_revalidated("get_url_cached", url, page_text)
 
 
-@cache_to_file
 def get_json_cached(url: str) -> str:
-    return get_response_cached(url).json()
+    return get_revalidated("get_json_cached", url, page_json)
+
+
+http_client: httpx.AsyncClient | None = None
+host_slots: dict[str, asyncio.Semaphore] = {}
+in_flight: dict[tuple[str, frozenset], asyncio.Future] = {}
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Returns the AsyncClient shared by all requests, so connections are kept
+    open and reused. HTTP/2 is used if the h2 package is installed."""
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+            ),
+            follow_redirects=True,
+        )
+    return http_client
+
+
+async def fetch(url: str, headers: dict[str, str] | None = None) -> httpx.Response:
+    host = httpx.URL(url).host
+    slots = host_slots.setdefault(host, asyncio.Semaphore(HTTP_MAX_PER_HOST))
+    async with slots:
+        with measure("http"):
+            response = await get_http_client().get(url, headers=headers)
+            if response.status_code != 304:
+                response.raise_for_status()
+    return response
+
+
+async def get_response_async(url: str, headers: dict[str, str] | None = None) -> httpx.Response:
+    """Fetches the url with the shared client.
+    Concurrent fetches of the same url with the same headers wait for the same
+    request. A conditional fetch may get a '304 Not Modified', so it isn't shared
+    with a fetch without or with other validators."""
+    url = with_scheme(url)
+    key = (url, frozenset((headers or {}).items()))
+    if key not in in_flight:
+        in_flight[key] = asyncio.ensure_future(fetch(url, headers))
+        in_flight[key].add_done_callback(lambda _: in_flight.pop(key, None))
+    # Shielded, so a cancelled caller doesn't cancel the fetch for the others.
+    return await asyncio.shield(in_flight[key])
+
+
+revalidating: set[asyncio.Task] = set()
+
+
+async def revalidate_async(name: str, key: str, url: str, entry: CacheEntry | None, parse):
+    response = await get_response_async(url, validator_headers(entry))
+    return store_response(name, key, entry, response, parse)
+
+
+async def revalidate_background(
+    name: str, key: str, url: str, entry: CacheEntry, parse
+) -> None:
+    try:
+        await revalidate_async(name, key, url, entry, parse)
+    except Exception as e:
+        print(f"Couldn't revalidate {url}: {e}")
+
+
+async def get_revalidated_async(name: str, url: str, parse):
+    """Same as get_revalidated, but asynchronous.
+    With CACHE_STALE_TIME, a recently expired result is returned right away,
+    and revalidated in the background."""
+    key = str((url,))
+    found, result = result_cache.get(name, key)
+    if found:
+        print(f"Returning cache for {key}")
+        return result
+
+    entry = result_cache.get_entry(name, key)
+    if entry is not None and time.time() - entry.time < CACHE_TIME + CACHE_STALE_TIME:
+        print(f"Returning stale cache for {key}")
+        task = asyncio.create_task(revalidate_background(name, key, url, entry, parse))
+        revalidating.add(task)
+        task.add_done_callback(revalidating.discard)
+        return entry.result
+
+    return await revalidate_async(name, key, url, entry, parse)
+
+
+async def get_url_async(url: str) -> str:
+    return await get_revalidated_async("get_url_cached", url, page_text)
+
+
+async def get_json_async(url: str) -> str:
+    return await get_revalidated_async("get_json_cached", url, page_json)
+
+
+# Query parameters which only track where the reader comes from.
+TRACKING_PARAMS = {
+    "fbclid",
+    "gclid",
+    "dclid",
+    "msclkid",
+    "yclid",
+    "igshid",
+    "mc_cid",
+    "mc_eid",
+    "mkt_tok",
+    "_hsenc",
+    "_hsmi",
+    "ref",
+    "ref_src",
+    "ref_url",
+    "cmpid",
+    "at_medium",
+    "at_campaign",
+}
+
+
+def normalize_url(url: str) -> str:
+    """Returns the URL without tracking parameters, fragment, and 'www.',
+    so the same article found on different sites has the same URL."""
+    parts = urlsplit(with_scheme(url.strip()))
+    host = parts.netloc.lower().removeprefix("www.")
+    path = parts.path.rstrip("/") or "/"
+    query = sorted(
+        (k, v)
+        for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not (k.lower().startswith("utm_") or k.lower() in TRACKING_PARAMS)
+    )
+    return urlunsplit((parts.scheme.lower(), host, path, urlencode(query), ""))
+
+
+async def canonical_url(url: str) -> str:
+    """Follows the redirections of the URL and returns the normalized final URL.
+    If the URL cannot be fetched, the normalized URL is returned."""
+    normalized = normalize_url(url)
+    found, result = result_cache.get("canonical_url", normalized)
+    if found:
+        return result
+
+    try:
+        response = await get_http_client().head(with_scheme(url.strip()))
+        result = normalize_url(str(response.url))
+    except Exception as e:
+        print(f"Couldn't resolve {url}: {e}")
+        return normalized
+
+    result_cache.set("canonical_url", normalized, result)
+    return result
@@ -0,0 +1,186 @@
+# extract - readable text of web pages, cut to a token budget - Licensed under AGPLv3 or later
+
+import os
+import re
+from html.parser import HTMLParser
+
+import httpx
+
+from common import get_revalidated_async
+from metrics import record_extraction
+
+# Maximum number of tokens of one article, of a scraped news site, and of all the
+# articles sent to the model in one prompt.
+ARTICLE_MAX_TOKENS = int(os.environ.get("ARTICLE_MAX_TOKENS", "3000"))
+SOURCE_MAX_TOKENS = int(os.environ.get("SOURCE_MAX_TOKENS", "8000"))
+PROMPT_MAX_TOKENS = int(os.environ.get("PROMPT_MAX_TOKENS", "12000"))
+
+SKIP_TAGS = {
+    "script",
+    "style",
+    "noscript",
+    "svg",
+    "nav",
+    "header",
+    "footer",
+    "aside",
+    "form",
+    "iframe",
+    "button",
+    "select",
+    "template",
+}
+BLOCK_TAGS = {
+    "p",
+    "div",
+    "section",
+    "article",
+    "main",
+    "li",
+    "ul",
+    "ol",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "br",
+    "tr",
+    "table",
+    "blockquote",
+    "pre",
+    "figcaption",
+}
+MAIN_TAGS = {"article", "main"}
+# Blocks with more than this part of their text in links are navigation.
+MAX_LINK_DENSITY = 0.5
+
+
+class TextExtractor(HTMLParser):
+    """Collects the text blocks of a page, without scripts, navigation, and link lists.
+    Blocks inside <article> or <main> are marked, as they are the main content."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.blocks: list[tuple[str, bool]] = []
+        self.skip = 0
+        self.link = 0
+        self.main = 0
+        self.text: list[str] = []
+        self.link_chars = 0
+
+    def handle_starttag(self, tag: str, attrs) -> None:
+        if tag in SKIP_TAGS:
+            self.skip += 1
+        elif tag == "a":
+            self.link += 1
+        if tag in BLOCK_TAGS:
+            self.flush()
+        if tag in MAIN_TAGS:
+            self.main += 1
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in SKIP_TAGS:
+            self.skip = max(0, self.skip - 1)
+        elif tag == "a":
+            self.link = max(0, self.link - 1)
+        if tag in BLOCK_TAGS:
+            self.flush()
+        if tag in MAIN_TAGS:
+            self.main = max(0, self.main - 1)
+
+    def handle_data(self, data: str) -> None:
+        if self.skip > 0:
+            return
+        self.text.append(data)
+        if self.link > 0:
+            self.link_chars += len(data.strip())
+
+    def flush(self) -> None:
+        block = " ".join(" ".join(self.text).split())
+        if block != "" and self.link_chars <= MAX_LINK_DENSITY * len(block):
+            self.blocks.append((block, self.main > 0))
+        self.text = []
+        self.link_chars = 0
+
+
+def html_to_text(page: str) -> str:
+    """Returns the readable text of the page.
+    If the page has an <article> or <main>, only their text is returned."""
+    extractor = TextExtractor()
+    extractor.feed(page)
+    extractor.close()
+    extractor.flush()
+    main = [block for block, in_main in extractor.blocks if in_main]
+    return "\n".join(main or [block for block, _ in extractor.blocks])
+
+
+MARKDOWN_IMAGE = re.compile(r"!\[[^\]]*\]\([^)]*\)")
+MARKDOWN_LINK = re.compile(r"\[([^\]]*)\]\([^)]*\)")
+
+
+def clean_markdown(markdown: str, keep_links: bool) -> str:
+    """Removes the images and empty lines of the markdown.
+    Without keep_links, lines which are mostly links are removed, and the other
+    links are replaced by their text."""
+    lines = []
+    for line in MARKDOWN_IMAGE.sub("", markdown).splitlines():
+        line = line.strip()
+        if line == "":
+            continue
+        if not keep_links:
+            text = MARKDOWN_LINK.sub(r"\1", line)
+            link_chars = sum(len(m.group(1)) for m in MARKDOWN_LINK.finditer(line))
+            if link_chars > MAX_LINK_DENSITY * len(text):
+                continue
+            line = text
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def estimate_tokens(text: str) -> int:
+    """About 4 characters per token for English text."""
+    return (len(text) + 3) // 4
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Cuts the text to max_tokens, at the end of a line if possible."""
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind("\n", 0, max_chars)
+    return text[: cut if cut > max_chars // 2 else max_chars] + "\n[...]"
+
+
+def chunk_by_tokens(texts: list[str], max_tokens: int) -> list[list[int]]:
+    """Splits the indexes of the texts in consecutive chunks of at most max_tokens.
+    A text longer than max_tokens gets its own chunk."""
+    chunks: list[list[int]] = [[]]
+    tokens = 0
+    for index, text in enumerate(texts):
+        size = estimate_tokens(text)
+        if chunks[-1] and tokens + size > max_tokens:
+            chunks.append([])
+            tokens = 0
+        chunks[-1].append(index)
+        tokens += size
+    return [chunk for chunk in chunks if chunk]
+
+
+def record_text(stage: str, bytes_in: int, text: str) -> None:
+    """Records the size of the page and of its text, and the tokens saved, see
+    metrics.record_extraction."""
+    saved = max(0, bytes_in // 4 - estimate_tokens(text))
+    record_extraction(stage, bytes_in, len(text), saved)
+
+
+def page_readable(response: httpx.Response) -> str:
+    text = truncate_tokens(html_to_text(response.text), ARTICLE_MAX_TOKENS)
+    record_text("extract_page", len(response.content), text)
+    return text
+
+
+async def get_text_async(url: str) -> str:
+    """Returns the readable text of the page, cut to ARTICLE_MAX_TOKENS."""
+    return await get_revalidated_async("get_text_cached", url, page_readable)
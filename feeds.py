@@ -0,0 +1,236 @@
+# feeds - read the news from the RSS / Atom feeds of the weekly URLs - Licensed under AGPLv3 or later
+
+import html
+import os
+import re
+import time
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+from xml.etree.ElementTree import Element, XMLPullParser
+
+from peewee import FloatField, Model, TextField
+from pydantic import BaseModel
+
+from articles import articles_db, source_articles, store_articles
+from common import (
+    RequestLogger,
+    get_http_client,
+    get_url_async,
+    normalize_url,
+    request_agent,
+    result_cache,
+    with_scheme,
+)
+from extract import PROMPT_MAX_TOKENS, chunk_by_tokens
+from resilience import call_agent
+from weekly_picks import NewsList, NewsSummary, score_news
+
+feed_logger = RequestLogger()
+
+# Articles of a feed are used for the weekly picks during FEED_ARTICLE_AGE seconds.
+FEED_ARTICLE_AGE = float(os.environ.get("FEED_ARTICLE_AGE", str(7 * 24 * 3600)))
+# Maximum number of articles read from a feed, and sent to score_news at once.
+FEED_MAX_ITEMS = int(os.environ.get("FEED_MAX_ITEMS", "40"))
+
+FEED_TYPES = {"application/rss+xml", "application/atom+xml", "application/feed+xml"}
+
+
+class FeedCursor(Model):
+    """The newest item read from the feed of a weekly URL, to only read newer ones next time."""
+
+    source = TextField(primary_key=True)
+    feed_url = TextField()
+    last_item = TextField()
+    time = FloatField()
+
+    class Meta:
+        database = articles_db
+
+
+articles_db.create_tables([FeedCursor])
+
+
+class FeedItem(BaseModel):
+    id: str
+    url: str
+    title: str
+    abstract: str
+
+
+class FeedLinks(HTMLParser):
+    """Collects the <link rel="alternate"> pointing to feeds."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.feeds: list[str] = []
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        attributes = dict(attrs)
+        if (
+            tag == "link"
+            and "alternate" in (attributes.get("rel") or "").lower().split()
+            and (attributes.get("type") or "").lower() in FEED_TYPES
+            and attributes.get("href")
+        ):
+            self.feeds.append(attributes["href"] or "")
+
+
+async def discover_feed(url: str) -> str | None:
+    """Returns the URL of the feed announced by the page, or the URL itself if it is a feed.
+    Returns None if the page has no feed."""
+    found, feed_url = result_cache.get("discover_feed", url)
+    if not found:
+        page = await get_url_async(url)
+        start = page.lstrip()[:500]
+        if start.startswith("<?xml") or "<rss" in start or "<feed" in start:
+            feed_url = with_scheme(url)
+        else:
+            links = FeedLinks()
+            links.feed(page)
+            feed_url = urljoin(with_scheme(url), links.feeds[0]) if links.feeds else ""
+        result_cache.set("discover_feed", url, feed_url)
+    return feed_url or None
+
+
+def local_name(element: Element) -> str:
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def child_text(element: Element, *names: str) -> str:
+    for child in element:
+        if local_name(child) in names and child.text:
+            return child.text.strip()
+    return ""
+
+
+def parse_item(element: Element) -> FeedItem:
+    """Reads an RSS <item> or an Atom <entry>."""
+    url = child_text(element, "link")
+    if url == "":
+        # Atom links are in the href attribute
+        for child in element:
+            if local_name(child) == "link" and child.get("rel", "alternate") == "alternate":
+                url = child.get("href", "")
+                break
+    abstract = child_text(element, "description", "summary", "content")
+    abstract = html.unescape(re.sub(r"<[^>]+>", " ", abstract))
+    return FeedItem(
+        id=child_text(element, "guid", "id") or url,
+        url=url,
+        title=child_text(element, "title"),
+        abstract=" ".join(abstract.split())[:500],
+    )
+
+
+async def read_feed(feed_url: str, last_item: str | None) -> list[FeedItem]:
+    """Reads the items of the feed while it is downloading, and stops at last_item,
+    or after FEED_MAX_ITEMS items."""
+    parser = XMLPullParser(events=("end",))
+    items: list[FeedItem] = []
+    async with get_http_client().stream("GET", feed_url) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                if local_name(element) not in ("item", "entry"):
+                    continue
+                item = parse_item(element)
+                element.clear()
+                if item.id == last_item or len(items) >= FEED_MAX_ITEMS:
+                    return items
+                if item.url != "":
+                    items.append(item)
+    return items
+
+
+async def new_feed_items(source: str, feed_url: str) -> list[FeedItem]:
+    """Returns the items of the feed which haven't been read before for this source."""
+    cursor = FeedCursor.get_or_none(FeedCursor.source == normalize_url(source))
+    if cursor is not None and cursor.feed_url == feed_url:
+        return await read_feed(feed_url, cursor.last_item)
+    return await read_feed(feed_url, None)
+
+
+def save_cursor(source: str, feed_url: str, items: list[FeedItem]) -> None:
+    if len(items) > 0:
+        FeedCursor.replace(
+            source=normalize_url(source),
+            feed_url=feed_url,
+            last_item=items[0].id,
+            time=time.time(),
+        ).execute()
+
+
+async def score_items(items: list[FeedItem], context: dict) -> list[NewsSummary]:
+    """Asks score_news for the relevance of the items, using only their title and abstract.
+    The items are sent in chunks of at most PROMPT_MAX_TOKENS."""
+    news_list = []
+    for chunk in chunk_by_tokens(
+        [item.model_dump_json() for item in items], PROMPT_MAX_TOKENS
+    ):
+        scorer = request_agent(
+            score_news(),
+            context={**context, "articles": [items[i].model_dump() for i in chunk]},
+        )
+        reply = await call_agent("score_news", scorer, "follow the instructions")
+        if not isinstance(reply.content, NewsList):
+            raise Exception(f"Couldn't score the articles: {reply.content}")
+
+        # Only keep the articles which have been sent.
+        urls = {items[i].url for i in chunk}
+        news_list += [news for news in reply.content.news_list if news.url in urls]
+    return news_list
+
+
+async def score_stored(
+    source: str, user: str, context: dict, since: float
+) -> list[NewsSummary] | None:
+    """Scores the articles stored for the source since the given time, which haven't
+    been scored for the user yet, e.g., because they were found for another user.
+    Returns all articles of the source, or None if there is nothing to score."""
+    scored, unscored = source_articles(source, user, since)
+    if len(unscored) == 0:
+        return None
+    items = [
+        FeedItem(id=a.canonical_url, url=a.url, title="", abstract=a.summary)
+        for a in unscored
+    ]
+    await feed_logger.debug(
+        f"Scoring {len(items)} stored articles from {source}, reusing {len(scored)}"
+    )
+    news_list = await score_items(items, context)
+    return scored + await store_articles(source, user, news_list)
+
+
+async def feed_news(
+    source: str, feed_url: str, user: str, context: dict
+) -> list[NewsSummary]:
+    """Returns the articles of the source from the last FEED_ARTICLE_AGE seconds,
+    scored for the user.
+    Only new items of the feed, and stored articles not yet scored for the user,
+    are sent to score_news."""
+    new_items = await new_feed_items(source, feed_url)
+    scored, unscored = source_articles(source, user, time.time() - FEED_ARTICLE_AGE)
+    stored_items = [
+        FeedItem(id=a.canonical_url, url=a.url, title="", abstract=a.summary)
+        for a in unscored
+    ]
+    if context["info"] != "":
+        # The personal_relevance depends on the info, so all articles are scored again.
+        stored_items += [
+            FeedItem(id=news.url, url=news.url, title="", abstract=news.summary)
+            for news in scored
+        ]
+        scored = []
+    items = (new_items + stored_items)[:FEED_MAX_ITEMS]
+    await feed_logger.debug(
+        f"Scoring {len(items)} articles from {feed_url}, reusing {len(scored)}"
+    )
+
+    news_list = await score_items(items, context)
+    news_list = await store_articles(
+        source, user, news_list, store_relevance=context["info"] == ""
+    )
+    # Only move the cursor once the new items are stored.
+    save_cursor(source, feed_url, new_items)
+    return scored + news_list
@@ -0,0 +1,254 @@
+# metrics - latency, token, error, and cache statistics per stage - Licensed under AGPLv3 or later
+
+import asyncio
+import json
+import os
+import time
+from contextlib import contextmanager
+from functools import cache
+
+# Upper bounds of the histogram buckets, the last bucket takes everything above.
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+TOKEN_BUCKETS = [100, 300, 1000, 3000, 10000, 30000, 100000]
+# USD per million input and output tokens, by model. Models not listed, like
+# local ones, cost nothing. TOKEN_PRICES adds or overrides models, e.g.,
+# "gpt-5-mini=0.25/2,claude-4-5-sonnet=3/15".
+MODEL_PRICES = {
+    "claude-4-5-sonnet": (3.0, 15.0),
+    "gpt-5-mini": (0.25, 2.0),
+}
+
+
+class Histogram:
+    def __init__(self, buckets: list[float]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = next(
+            (i for i, bound in enumerate(self.buckets) if value <= bound),
+            len(self.buckets),
+        )
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> dict:
+        return {
+            "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], self.counts)),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+class StageStats:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Pages reduced to their text: bytes fetched, characters kept, and the
+        # estimated tokens not sent to the model.
+        self.extractions = 0
+        self.bytes_in = 0
+        self.text_out = 0
+        self.tokens_saved = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.tokens_in = Histogram(TOKEN_BUCKETS)
+        self.tokens_out = Histogram(TOKEN_BUCKETS)
+        self.cost = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "extractions": self.extractions,
+            "bytes_in": self.bytes_in,
+            "text_out": self.text_out,
+            "tokens_saved": self.tokens_saved,
+            "cost": self.cost,
+            "latency": self.latency.to_dict(),
+            "tokens_in": self.tokens_in.to_dict(),
+            "tokens_out": self.tokens_out.to_dict(),
+        }
+
+
+# Statistics by (stage, model). The model is "" for stages not using one.
+stages: dict[tuple[str, str], StageStats] = {}
+# Seconds spent in every step of the start of the bot.
+startup: dict[str, float] = {}
+
+
+def stage_stats(stage: str, model: str = "") -> StageStats:
+    return stages.setdefault((stage, model), StageStats())
+
+
+@cache
+def model_prices() -> dict[str, tuple[float, float]]:
+    """MODEL_PRICES with TOKEN_PRICES. It is read on first use, once common.py
+    loaded the .env file."""
+    prices = dict(MODEL_PRICES)
+    for price in os.environ.get("TOKEN_PRICES", "").split(","):
+        if price.strip() != "":
+            name, _, per_token = price.partition("=")
+            price_in, _, price_out = per_token.partition("/")
+            prices[name.strip()] = (float(price_in), float(price_out or price_in))
+    return prices
+
+
+def cost(model: str, tokens_in: int, tokens_out: int) -> float:
+    price_in, price_out = model_prices().get(model, (0.0, 0.0))
+    return (tokens_in * price_in + tokens_out * price_out) / 1_000_000
+
+
+def record(
+    stage: str,
+    model: str,
+    seconds: float,
+    error: bool = False,
+    tokens_in: int = 0,
+    tokens_out: int = 0,
+) -> None:
+    stats = stage_stats(stage, model)
+    stats.calls += 1
+    stats.errors += int(error)
+    stats.latency.observe(seconds)
+    if tokens_in > 0 or tokens_out > 0:
+        stats.tokens_in.observe(tokens_in)
+        stats.tokens_out.observe(tokens_out)
+        stats.cost += cost(model, tokens_in, tokens_out)
+
+
+def record_cache(stage: str, hit: bool) -> None:
+    stats = stage_stats(stage)
+    if hit:
+        stats.cache_hits += 1
+    else:
+        stats.cache_misses += 1
+
+
+def record_extraction(stage: str, bytes_in: int, text_out: int, tokens_saved: int) -> None:
+    stats = stage_stats(stage)
+    stats.extractions += 1
+    stats.bytes_in += bytes_in
+    stats.text_out += text_out
+    stats.tokens_saved += tokens_saved
+
+
+@contextmanager
+def measure(stage: str, model: str = ""):
+    """Records the time spent in the block, and whether it raised."""
+    start = time.monotonic()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        record(stage, model, time.monotonic() - start, error)
+
+
+def model_name(agent) -> str:
+    return getattr(agent.model, "id", "") or ""
+
+
+async def run_agent(stage: str, agent, *args, **kwargs):
+    """Returns agent.arun(*args, **kwargs), and records its latency, tokens, and
+    whether it failed or got cancelled, under the stage and the model of the agent."""
+    start = time.monotonic()
+    try:
+        response = await agent.arun(*args, **kwargs)
+    except BaseException:
+        record(stage, model_name(agent), time.monotonic() - start, error=True)
+        raise
+    metrics = getattr(response, "metrics", None) or {}
+    record(
+        stage,
+        model_name(agent),
+        time.monotonic() - start,
+        tokens_in=sum(metrics.get("input_tokens", [])),
+        tokens_out=sum(metrics.get("output_tokens", [])),
+    )
+    return response
+
+
+def to_json() -> list[dict]:
+    return [
+        {"stage": stage, "model": model, **stats.to_dict()}
+        for (stage, model), stats in sorted(stages.items())
+    ]
+
+
+def to_prometheus() -> str:
+    """Returns the statistics in the Prometheus text format."""
+    lines = [
+        f'c4dt_startup_seconds{{step="{step}"}} {seconds}'
+        for step, seconds in startup.items()
+    ]
+    for (stage, model), stats in sorted(stages.items()):
+        labels = f'stage="{stage}",model="{model}"'
+        for name in [
+            "calls",
+            "errors",
+            "cache_hits",
+            "cache_misses",
+            "extractions",
+            "bytes_in",
+            "text_out",
+            "tokens_saved",
+        ]:
+            lines.append(f"c4dt_{name}_total{{{labels}}} {getattr(stats, name)}")
+        lines.append(f"c4dt_cost_usd_total{{{labels}}} {stats.cost}")
+        for name in ["latency", "tokens_in", "tokens_out"]:
+            histogram: Histogram = getattr(stats, name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append(
+                    f'c4dt_{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+                )
+            lines.append(f"c4dt_{name}_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"c4dt_{name}_count{{{labels}}} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+async def dump_metrics(path: str, interval: float) -> None:
+    """Writes the statistics as JSON to path every interval seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump(
+                    {"time": time.time(), "startup": startup, "stages": to_json()},
+                    f,
+                    indent=1,
+                )
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            print(f"Couldn't write the metrics to {path}: {e}")
+
+
+async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        await reader.readline()
+        body = to_prometheus().encode()
+        writer.write(
+            b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve_metrics(port: int) -> None:
+    """Serves the statistics in the Prometheus text format on localhost:port."""
+    server = await asyncio.start_server(handle_request, "127.0.0.1", port)
+    async with server:
+        await server.serve_forever()
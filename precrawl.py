@@ -0,0 +1,87 @@
+# precrawl - scrape the weekly URLs in the background, so weekly picks use warm data - Licensed under AGPLv3 or later
+
+import asyncio
+import datetime
+import os
+import random
+
+import users
+from agent import get_personal_interest, get_weekly_urls, scrape_source
+from articles import ARTICLE_REUSE_TIME
+from common import ALLOWED_USERS, StdLogger, normalize_url, set_logger
+
+# Seconds between two pre-crawls, 0 to disable them. It should be shorter than
+# ARTICLE_REUSE_TIME, so the weekly picks find the articles still fresh.
+PRECRAWL_INTERVAL = float(
+    os.environ.get("PRECRAWL_INTERVAL", str(min(4 * 3600, ARTICLE_REUSE_TIME * 2 / 3)))
+)
+# Every pre-crawl starts up to PRECRAWL_JITTER seconds earlier or later.
+PRECRAWL_JITTER = float(os.environ.get("PRECRAWL_JITTER", "600"))
+# How many weekly URLs are pre-crawled at the same time.
+PRECRAWL_CONCURRENCY = int(os.environ.get("PRECRAWL_CONCURRENCY", "2"))
+# Hours of the day without pre-crawl, e.g., "22-6". Empty for none.
+PRECRAWL_QUIET_HOURS = os.environ.get("PRECRAWL_QUIET_HOURS", "")
+
+
+def in_quiet_hours(hour: int) -> bool:
+    if PRECRAWL_QUIET_HOURS.strip() == "":
+        return False
+    start, end = [int(h) % 24 for h in PRECRAWL_QUIET_HOURS.split("-")]
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def sources_by_url() -> dict[str, list[tuple[str, str]]]:
+    """Returns the weekly URLs of all users, once per normalized URL, with the
+    users having it, as (user, url) pairs.
+    The allowed users who didn't write to the bot yet have no entry, but use the
+    default weekly URLs, so these are pre-crawled too."""
+    sources: dict[str, list[tuple[str, str]]] = {}
+    known = users.all_users()
+    allowed = sorted(u for u in ALLOWED_USERS if u.startswith("@") and u not in known)
+    for user in known + allowed:
+        for url in get_weekly_urls(user):
+            if url.strip() != "":
+                sources.setdefault(normalize_url(url), []).append((user, url))
+    return sources
+
+
+async def precrawl_source(
+    source: list[tuple[str, str]], semaphore: asyncio.Semaphore
+) -> None:
+    """The first user scrapes the URL, the others reuse or only score the stored articles.
+    The first one always refreshes, as reusing the articles would neither scrape the
+    URL nor poll its feed, and the articles would expire before the next pre-crawl."""
+    for index, (user, url) in enumerate(source):
+        context = {"personal_interest": get_personal_interest(user), "info": ""}
+        try:
+            await scrape_source(url, user, context, index == 0, semaphore)
+        except Exception as e:
+            print(f"Couldn't pre-crawl {url} for {user}: {e!r}")
+
+
+async def precrawl() -> None:
+    sources = sources_by_url()
+    print(f"Pre-crawling {len(sources)} weekly URLs")
+    semaphore = asyncio.Semaphore(max(1, PRECRAWL_CONCURRENCY))
+    await asyncio.gather(
+        *[precrawl_source(source, semaphore) for source in sources.values()]
+    )
+    print("Pre-crawl done")
+
+
+async def run_precrawl() -> None:
+    """Pre-crawls every PRECRAWL_INTERVAL seconds, except during PRECRAWL_QUIET_HOURS.
+    The first pre-crawl starts within PRECRAWL_JITTER seconds."""
+    set_logger(StdLogger())
+    delay = random.uniform(0, PRECRAWL_JITTER)
+    while True:
+        await asyncio.sleep(delay)
+        delay = max(0, PRECRAWL_INTERVAL + random.uniform(-PRECRAWL_JITTER, PRECRAWL_JITTER))
+        if in_quiet_hours(datetime.datetime.now().hour):
+            continue
+        try:
+            await precrawl()
+        except Exception as e:
+            print(f"Pre-crawl failed: {e!r}")
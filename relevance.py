@@ -0,0 +1,83 @@
+# relevance - personal_relevance of articles computed locally, without the model - Licensed under AGPLv3 or later
+
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+from weekly_picks import NewsSummary
+
+WORD = re.compile(r"[a-z0-9][a-z0-9]+")
+STOPWORDS = set(
+    """
+    of to in on at is it an as by or be we me my am do so if no up us
+    the and for are but not you all any can her was one our out has have had his how
+    its may new now who why with this that from they them their there what when which
+    will would about into more most also than then these those been being were like
+    likes just very much some such only other over should could does user article
+    articles news www com html https http
+    """.split()
+)
+# Parameters of BM25: saturation of the term frequency, and length normalization.
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+@lru_cache(maxsize=8192)
+def terms(text: str) -> tuple[str, ...]:
+    """The words of the text, without stop words and plural 's'."""
+    words = []
+    for word in WORD.findall(text.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.append(word)
+    return tuple(words)
+
+
+def article_terms(news: NewsSummary) -> tuple[str, ...]:
+    """The words of the summary, and of the URL path, which often holds the title."""
+    return terms(news.summary + " " + re.sub(r"[/\-_.]", " ", urlsplit(news.url).path))
+
+
+def bm25_scores(query: tuple[str, ...], documents: list[tuple[str, ...]]) -> list[float]:
+    """Returns the BM25 score of every document for the query. Words appearing
+    several times in the query weigh more."""
+    if len(documents) == 0:
+        return []
+    average = sum(len(d) for d in documents) / len(documents) or 1
+    frequency = Counter(word for d in documents for word in set(d))
+    weights = Counter(query)
+    idf = {
+        word: math.log(
+            1 + (len(documents) - frequency[word] + 0.5) / (frequency[word] + 0.5)
+        )
+        for word in weights
+    }
+    scores = []
+    for document in documents:
+        counts = Counter(document)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * len(document) / average)
+        scores.append(
+            sum(
+                weight * idf[word] * counts[word] * (BM25_K1 + 1) / (counts[word] + norm)
+                for word, weight in weights.items()
+                if word in counts
+            )
+        )
+    return scores
+
+
+def personal_relevance(news_list: list[NewsSummary], interest: str) -> list[NewsSummary]:
+    """Returns the articles with their personal_relevance replaced by how well they
+    match the interest, from 0 to 10 for the best matching article."""
+    scores = bm25_scores(terms(interest), [article_terms(news) for news in news_list])
+    best = max(scores, default=0)
+    return [
+        news.model_copy(
+            update={"personal_relevance": round(10 * score / best, 1) if best > 0 else 0}
+        )
+        for news, score in zip(news_list, scores)
+    ]
@@ -0,0 +1,240 @@
+# resilience - deadlines, retries, failover, and hedging for the model calls - Licensed under AGPLv3 or later
+
+import asyncio
+import copy
+import os
+import random
+import time
+from typing import Awaitable, Callable
+
+from agno.run.response import RunResponseContentEvent
+
+from common import make_model, request_agent
+from metrics import measure, model_name, run_agent, stages
+
+# Seconds one model call, with its tool calls, may take before it is abandoned.
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "180"))
+# Failed or timed out calls are retried LLM_RETRIES times, after a random delay
+# of up to LLM_RETRY_DELAY seconds, doubling with every retry.
+LLM_RETRIES = int(os.environ.get("LLM_RETRIES", "2"))
+LLM_RETRY_DELAY = float(os.environ.get("LLM_RETRY_DELAY", "1"))
+# After BREAKER_FAILURES failures in a row, a provider isn't used for
+# BREAKER_COOLDOWN seconds, then a single call tries it again.
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "3"))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "60"))
+# Model used while the provider of an agent is failing, as "backend:id", see
+# common.make_model. Empty for none.
+LLM_FALLBACK = os.environ.get("LLM_FALLBACK", "")
+# If set, a call slower than the HEDGE_PERCENTILE percentile of the latencies of
+# its stage is also sent to LLM_FALLBACK, and the first answer is taken.
+# The latencies are only used once the stage has HEDGE_MIN_CALLS calls.
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "0"))
+HEDGE_MIN_CALLS = int(os.environ.get("HEDGE_MIN_CALLS", "20"))
+
+# Created on first use, or set directly, e.g., by the benchmark.
+fallback = None
+
+
+class ModelUnavailable(Exception):
+    """Neither the model of the agent nor the fallback can be used right now."""
+
+
+class ModelTimeout(Exception):
+    """The model didn't answer within LLM_TIMEOUT. It isn't a TimeoutError, so
+    it isn't taken for the timeout of the caller."""
+
+
+class CircuitBreaker:
+    def __init__(self) -> None:
+        self.failures = 0
+        self.opened = 0.0
+        self.trying = False
+
+    def available(self) -> bool:
+        return (
+            self.failures < BREAKER_FAILURES
+            or time.monotonic() - self.opened >= BREAKER_COOLDOWN
+        )
+
+    def allow(self) -> bool:
+        """Whether a call may go to the provider. Once the cooldown is over, only
+        one call at a time is let through until one succeeds."""
+        if self.failures < BREAKER_FAILURES:
+            return True
+        if not self.available() or self.trying:
+            return False
+        self.trying = True
+        return True
+
+    def success(self) -> None:
+        self.failures = 0
+        self.trying = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self.trying = False
+        if self.failures >= BREAKER_FAILURES:
+            self.opened = time.monotonic()
+
+
+# Circuit breakers by provider
+breakers: dict[str, CircuitBreaker] = {}
+
+
+def breaker(model) -> CircuitBreaker:
+    """Models on the same server share the breaker, so do the hosted ones of
+    the same provider."""
+    provider = getattr(model, "base_url", None) or model.provider or type(model).__name__
+    return breakers.setdefault(str(provider), CircuitBreaker())
+
+
+def fallback_model():
+    global fallback
+    if fallback is None and LLM_FALLBACK.strip() != "":
+        fallback = make_model(LLM_FALLBACK)
+    return fallback
+
+
+def model_available(model) -> bool:
+    """Whether the model can be called now, without waiting for its breaker."""
+    return breaker(model).available()
+
+
+def hedge_delay(stage: str, model: str) -> float | None:
+    """Returns the HEDGE_PERCENTILE latency of the stage and model, or None if
+    there are not enough calls yet."""
+    stats = stages.get((stage, model))
+    if HEDGE_PERCENTILE <= 0 or stats is None or stats.latency.count < HEDGE_MIN_CALLS:
+        return None
+    needed = stats.latency.count * HEDGE_PERCENTILE / 100
+    seen = 0
+    for bound, count in zip(stats.latency.buckets, stats.latency.counts):
+        seen += count
+        if seen >= needed:
+            return bound
+    return None
+
+
+async def attempt(stage: str, agent, *args, **kwargs):
+    """Runs the agent once, with LLM_TIMEOUT, and tells its breaker how it went."""
+    model_breaker = breaker(agent.model)
+    try:
+        response = await asyncio.wait_for(
+            run_agent(stage, agent, *args, **kwargs), LLM_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        model_breaker.failure()
+        raise ModelTimeout(f"No answer from {model_name(agent)} after {LLM_TIMEOUT}s")
+    except Exception:
+        model_breaker.failure()
+        raise
+    finally:
+        # A call cancelled by the hedge counts neither way.
+        model_breaker.trying = False
+    model_breaker.success()
+    return response
+
+
+async def stream_agent(
+    stage: str, agent, on_partial: Callable[[str], Awaitable[None]], *args, **kwargs
+) -> str:
+    """Streams agent.arun(*args, **kwargs), calling on_partial with the text so far,
+    and returns the whole text. Like attempt, the stream has LLM_TIMEOUT, and
+    its breaker is told how it went. It is not retried, as the text has already
+    been shown."""
+    model_breaker = breaker(agent.model)
+    if not model_breaker.allow():
+        raise ModelUnavailable(f"The model {model_name(agent)} is failing")
+    text = ""
+    try:
+        with measure(stage, model_name(agent)):
+            async with asyncio.timeout(LLM_TIMEOUT):
+                async for event in await agent.arun(*args, stream=True, **kwargs):
+                    if isinstance(event, RunResponseContentEvent) and isinstance(
+                        event.content, str
+                    ):
+                        text += event.content
+                        await on_partial(text)
+    except asyncio.TimeoutError:
+        model_breaker.failure()
+        raise ModelTimeout(f"No answer from {model_name(agent)} after {LLM_TIMEOUT}s")
+    except Exception:
+        model_breaker.failure()
+        raise
+    finally:
+        model_breaker.trying = False
+    model_breaker.success()
+    return text
+
+
+async def hedged(stage: str, agent, *args, **kwargs):
+    """Runs the agent, and if it is slower than usual, a copy of it with the
+    fallback model. The first answer is returned, and the other call cancelled."""
+    secondary = fallback_model()
+    delay = hedge_delay(stage, model_name(agent))
+    if (
+        delay is None
+        or secondary is None
+        or breaker(secondary) is breaker(agent.model)
+        or not model_available(secondary)
+    ):
+        return await attempt(stage, agent, *args, **kwargs)
+
+    initial_state = copy.deepcopy(agent.session_state)
+    first = asyncio.ensure_future(attempt(stage, agent, *args, **kwargs))
+    done, _ = await asyncio.wait([first], timeout=delay)
+    if first in done or not breaker(secondary).allow():
+        return await first
+
+    hedge = request_agent(agent, model=secondary, session_state=initial_state)
+    second = asyncio.ensure_future(attempt(f"{stage}_hedge", hedge, *args, **kwargs))
+    pending = {first, second}
+    try:
+        while len(pending) > 0:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        first.cancel()
+                        agent.session_state = hedge.session_state
+                    return task.result()
+        return first.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def call_agent(stage: str, agent, *args, **kwargs):
+    """Returns agent.arun(*args, **kwargs) like metrics.run_agent, but every call
+    has LLM_TIMEOUT, and failed calls are retried with a jittered backoff.
+    While the provider of the agent fails, the calls go to LLM_FALLBACK, and if
+    there is none, ModelUnavailable is raised without calling the model.
+    The session_state of the agent only keeps the changes of the successful call."""
+    initial_state = copy.deepcopy(agent.session_state)
+    error: Exception | None = None
+    for retry in range(LLM_RETRIES + 1):
+        if retry > 0:
+            await asyncio.sleep(random.uniform(0, LLM_RETRY_DELAY * 2 ** (retry - 1)))
+            agent.session_state = copy.deepcopy(initial_state)
+
+        if breaker(agent.model).allow():
+            runner = agent
+        elif fallback_model() is not None and breaker(fallback_model()).allow():
+            runner = request_agent(agent, model=fallback_model())
+        else:
+            raise ModelUnavailable(
+                f"The model {model_name(agent)} is failing, and no fallback is available"
+            ) from error
+
+        try:
+            response = await hedged(stage, runner, *args, **kwargs)
+        except Exception as e:
+            print(f"Model call for {stage} failed ({retry + 1}/{LLM_RETRIES + 1}): {e!r}")
+            error = e
+            continue
+        if runner is not agent:
+            agent.session_state = runner.session_state
+        return response
+    raise ModelUnavailable(
+        f"The model {model_name(agent)} failed {LLM_RETRIES + 1} times"
+    ) from error
@@ -0,0 +1,96 @@
+# scrape - Firecrawl scrapes shared by all agents and users - Licensed under AGPLv3 or later
+
+import asyncio
+import functools
+import json
+import os
+
+from agno.tools import Toolkit
+
+from cache import Cache
+from common import CACHE_HOT_MB, canonical_url, data_dir
+from extract import clean_markdown, record_text, truncate_tokens
+from metrics import measure, record_cache
+
+# Scraped pages are reused for SCRAPE_CACHE_TIME seconds, and at most SCRAPE_CACHE_MB are kept.
+SCRAPE_CACHE_TIME = float(os.environ.get("SCRAPE_CACHE_TIME", "3600"))
+SCRAPE_CACHE_MB = int(os.environ.get("SCRAPE_CACHE_MB", "100"))
+
+scrape_cache = Cache(
+    f"{data_dir}/scrapes.db",
+    ttl=SCRAPE_CACHE_TIME,
+    keep=SCRAPE_CACHE_TIME,
+    max_size=SCRAPE_CACHE_MB * 1_000_000,
+    hot_size=CACHE_HOT_MB * 1_000_000 // 4,
+)
+# Firecrawl calls running, by canonical URL
+scrapes_in_flight: dict[str, asyncio.Future] = {}
+# Set to use another Firecrawl client than firecrawl_app, e.g., by the benchmark.
+# It isn't kept in the ScrapeTools, as the agents copy their tools for every request.
+firecrawl_client = None
+
+
+async def firecrawl(app, url: str, key: str) -> dict:
+    with measure("firecrawl"):
+        # The Firecrawl client is synchronous, so it runs in a thread.
+        result = await asyncio.to_thread(app.scrape_url, url, formats=["markdown"])
+    metadata = result.metadata if isinstance(result.metadata, dict) else {}
+    page = {
+        "markdown": result.markdown or "",
+        "title": metadata.get("title"),
+        "size": len(result.model_dump_json()),
+    }
+    scrape_cache.set("firecrawl", key, page)
+    return page
+
+
+async def scrape(app, url: str) -> dict:
+    """Returns the markdown, title, and size of the Firecrawl result for the url.
+    The result is stored by canonical URL, and concurrent scrapes of the same page
+    wait for the same Firecrawl call."""
+    key = await canonical_url(url)
+    found, page = scrape_cache.get("firecrawl", key)
+    if found:
+        return page
+    if key in scrapes_in_flight:
+        record_cache("firecrawl_in_flight", True)
+    else:
+        scrapes_in_flight[key] = asyncio.ensure_future(firecrawl(app, url, key))
+        scrapes_in_flight[key].add_done_callback(
+            lambda _: scrapes_in_flight.pop(key, None)
+        )
+    # Shielded, so a cancelled agent doesn't cancel the scrape for the others.
+    return await asyncio.shield(scrapes_in_flight[key])
+
+
+@functools.cache
+def firecrawl_app():
+    """The Firecrawl client, created and imported on the first scrape, as the
+    firecrawl package is slow to import."""
+    from firecrawl import FirecrawlApp
+
+    return FirecrawlApp(api_key=os.getenv("FIRECRAWL_API_KEY"))
+
+
+class ScrapeTools(Toolkit):
+    """Like FirecrawlTools, but only returns the markdown of the page, cleaned up
+    and cut to max_tokens, instead of the whole Firecrawl result.
+    The scrapes are shared by all ScrapeTools, see scrape."""
+
+    def __init__(self, max_tokens: int, keep_links: bool) -> None:
+        super().__init__(name="firecrawl_tools", tools=[self.scrape_website])
+        self.max_tokens = max_tokens
+        self.keep_links = keep_links
+
+    async def scrape_website(self, url: str) -> str:
+        """Use this function to scrape a website using Firecrawl.
+
+        Args:
+            url (str): The URL to scrape.
+        """
+        page = await scrape(firecrawl_client or firecrawl_app(), url)
+        text = truncate_tokens(
+            clean_markdown(page["markdown"], self.keep_links), self.max_tokens
+        )
+        record_text("extract_scrape", page["size"], text)
+        return json.dumps({"url": url, "title": page["title"], "content": text})
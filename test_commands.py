@@ -0,0 +1,52 @@
+# test_commands - the commands recognized without the model - Licensed under AGPLv3 or later
+
+import os
+import tempfile
+
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="c4dt-test-")
+
+import pytest
+
+from agent import AgCmd, get_weekly_urls, parse_command_locally
+
+USER = "@test:example"
+
+# Message, and the expected command and arguments, or None if the model decides.
+CASES = [
+    ("help", AgCmd.HELP, []),
+    ("?", AgCmd.HELP, []),
+    ("weekly", AgCmd.WEEKLY, ["3"]),
+    ("give me 5 weekly picks", AgCmd.WEEKLY, ["5"]),
+    ("weekly on microsoft security", AgCmd.WEEKLY, ["3", "microsoft security"]),
+    ("refresh weekly", AgCmd.WEEKLY, ["3", "", "refresh"]),
+    ("show my urls", AgCmd.WEEKLY_URLS_GET, []),
+    ("https://example.com", AgCmd.WEEKLY_URLS_UPDATE, ["https://example.com"]),
+    ("www.example.com/news", AgCmd.WEEKLY_URLS_UPDATE, ["www.example.com/news"]),
+    (
+        "https://a.example, http://b.example:8080/feed",
+        AgCmd.WEEKLY_URLS_UPDATE,
+        ["https://a.example", "http://b.example:8080/feed"],
+    ),
+    ("node.js", None, None),
+    ("README.md", None, None),
+    ("config.py", None, None),
+    ("Thanks.Bye", None, None),
+    ("example.com", None, None),
+    ("https://example.com and node.js", None, None),
+    ("What is the capital of Switzerland?", None, None),
+]
+
+
+@pytest.mark.parametrize("message, command, arguments", CASES)
+def test_parse_command_locally(message, command, arguments):
+    parsed = parse_command_locally(USER, message)
+    if command is None:
+        assert parsed is None
+    else:
+        assert parsed is not None
+        assert parsed.command == command
+        expected = arguments
+        if command == AgCmd.WEEKLY_URLS_UPDATE:
+            # The new URLs are added to the current ones.
+            expected = [url for url in get_weekly_urls(USER) if url != ""] + arguments
+        assert parsed.arguments == expected
@@ -0,0 +1,88 @@
+# users - per-user state of the bot - Licensed under AGPLv3 or later
+
+import json
+import os
+
+from cachetools import LRUCache
+from peewee import Model, SqliteDatabase, TextField
+
+from common import data_dir
+
+users_db = SqliteDatabase(
+    f"{data_dir}/users.db", pragmas={"journal_mode": "wal", "synchronous": "normal"}
+)
+
+
+class UserState(Model):
+    user = TextField(primary_key=True)
+    personal_interest = TextField(null=True)
+    # JSON encoded list of URLs
+    weekly_urls = TextField(null=True)
+
+    class Meta:
+        database = users_db
+
+
+users_db.create_tables([UserState])
+
+# The states read from the database, removed whenever the user is updated.
+user_cache: LRUCache = LRUCache(maxsize=1024)
+
+
+def get_user(user: str) -> UserState | None:
+    if user not in user_cache:
+        user_cache[user] = UserState.get_or_none(UserState.user == user)
+    return user_cache[user]
+
+
+def update_user(user: str, **fields) -> None:
+    """Updates only the given fields of the user, creating it if needed."""
+    UserState.insert(user=user, **fields).on_conflict(
+        conflict_target=[UserState.user],
+        update={getattr(UserState, name): value for name, value in fields.items()},
+    ).execute()
+    user_cache.pop(user, None)
+
+
+def get_personal_interest(user: str) -> str | None:
+    state = get_user(user)
+    return state.personal_interest if state is not None else None
+
+
+def set_personal_interest(user: str, personal_interest: str) -> None:
+    update_user(user, personal_interest=personal_interest)
+
+
+def get_weekly_urls(user: str) -> list[str] | None:
+    state = get_user(user)
+    if state is None or state.weekly_urls is None:
+        return None
+    return json.loads(state.weekly_urls)
+
+
+def set_weekly_urls(user: str, urls: list[str]) -> None:
+    update_user(user, weekly_urls=json.dumps(urls))
+
+
+def all_users() -> list[str]:
+    return [state.user for state in UserState.select(UserState.user)]
+
+
+def migrate_json(personal_interests_file: str, weekly_urls_file: str) -> None:
+    """Moves the users from the JSON files of previous versions to the database.
+    The files are renamed to *.migrated, so this only happens once."""
+    for file, field in [
+        (personal_interests_file, "personal_interest"),
+        (weekly_urls_file, "weekly_urls"),
+    ]:
+        if not os.path.exists(file):
+            continue
+        with open(file, "r") as f:
+            values = json.load(f)
+        with users_db.atomic():
+            for user, value in values.items():
+                if field == "weekly_urls":
+                    value = json.dumps(value)
+                update_user(user, **{field: value})
+        os.rename(file, file + ".migrated")
+        print(f"Migrated {len(values)} users from {file}")
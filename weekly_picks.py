@@ -1,19 +1,16 @@
 # weekly_picks - how to scrape websites for interesting articles - Licensed under AGPLv3 or later
 
 from textwrap import dedent
+from urllib.parse import urlsplit
 
 from agno.agent import Agent
-from agno.tools.firecrawl import FirecrawlTools
 from pydantic import BaseModel, Field
 
-from common import AGENT_CONFIG, ProgressLogger, StdLogger
+from common import RequestLogger, agent_config, lazy_agent
+from extract import ARTICLE_MAX_TOKENS, SOURCE_MAX_TOKENS
+from scrape import ScrapeTools
 
-wp_logger = StdLogger()
-
-
-def set_logger(logger: ProgressLogger):
-    global wp_logger
-    wp_logger = logger
+wp_logger = RequestLogger()
 
 
 class NewsSummary(BaseModel):
@@ -35,21 +32,51 @@ async def add_news(agent: Agent, news: NewsSummary):
     agent.session_state["news_list"].append(news)
 
 
-list_news = Agent(
-    **AGENT_CONFIG,
-    description="Fetches the latest news and returns a summary",
-    tools=[FirecrawlTools(crawl=False), add_news],
-    session_state={"news_list": []},
-    context={"personal_interest": "", "info": ""},
-    instructions=dedent("""\
-        Visit the url from the prompt, and then choose the 5 most relevant articles related to digital trust to the news_list.
-        For the dt_relevance field, only consider the relevance with regard to digital trust, cybersecurity, policy,
-        attacks, as well as defenses. Consider articles which talk about defenses or how to fix
-        privacy issues higher than articles which only complain about those issues.
+@lazy_agent
+def list_news() -> Agent:
+    return Agent(
+        **agent_config("list_news"),
+        description="Fetches the latest news and returns a summary",
+        tools=[ScrapeTools(SOURCE_MAX_TOKENS, keep_links=True), add_news],
+        session_state={"news_list": []},
+        context={"personal_interest": "", "info": ""},
+        instructions=dedent("""\
+            Visit the url from the prompt, and then choose the 5 most relevant articles related to digital trust to the news_list.
+            For the dt_relevance field, only consider the relevance with regard to digital trust, cybersecurity, policy,
+            attacks, as well as defenses. Consider articles which talk about defenses or how to fix
+            privacy issues higher than articles which only complain about those issues.
+
+            You can find the personal_relevance and optional additional infos in the context.
+            """),
+    )
+
+
+class NewsList(BaseModel):
+    news_list: list[NewsSummary]
+
+
+@lazy_agent
+def score_news() -> Agent:
+    return Agent(
+        **agent_config("score_news"),
+        description="Scores a list of articles read from a news feed",
+        context={"personal_interest": "", "info": "", "articles": []},
+        instructions=dedent("""\
+            You can find a list of articles with their title and abstract in the articles context.
+            Don't visit the articles, only use the title and the abstract.
+            For every article, return its url unchanged, a short summary, and the dt_relevance
+            and personal_relevance.
+            For the dt_relevance field, only consider the relevance with regard to digital trust, cybersecurity, policy,
+            attacks, as well as defenses. Consider articles which talk about defenses or how to fix
+            privacy issues higher than articles which only complain about those issues.
+
+            You can find the personal_relevance and optional additional infos in the context.
 
-        You can find the personal_relevance and optional additional infos in the context.
-        """),
-)
+            For the final reply, only send the JSON, nothing else. Don't introduce the JSON, just send the json.
+            The result will be parsed with JSON.parse, so don't introduce it in any way.
+            """),
+        response_model=NewsList,
+    )
 
 
 class Url(BaseModel):
@@ -60,22 +87,58 @@ class UrlList(BaseModel):
     url_list: list[Url]
 
 
-order_news = Agent(
-    **AGENT_CONFIG,
-    description="Returns the top articles by relevance",
-    context={"number_takes": "3", "news_list": ""},
-    instructions=dedent("""\
-        You can find a list of articles scraped by the previous agent in the news_list context.
-        You need to return the top number_takes articles from this list.
-
-        Use the dt_relevance and personal_relevance fields which go from 0 (not relevant) to 10 (very relevant).
-        Of course you should also use the summary field.
-
-        For the final reply, only send the JSON, nothing else. Don't introduce the JSON, just send the json.
-        The result will be parsed with JSON.parse, so don't introduce it in any way.
-        """),
-    response_model=UrlList,
-)
+def rank_news(
+    news_list: list[NewsSummary],
+    number_takes: int,
+    dt_weight: float = 1.0,
+    personal_weight: float = 1.0,
+    source_penalty: float = 0.0,
+) -> list[NewsSummary]:
+    """Returns the number_takes best articles, using the weighted sum of dt_relevance
+    and personal_relevance. Ties are broken by dt_relevance, then by the order of news_list.
+    Every article already taken from a site lowers the score of the other articles from
+    the same site by source_penalty, so the picks come from different sites."""
+    remaining = list(enumerate(news_list))
+    taken_per_site: dict[str, int] = {}
+    ranked = []
+    while remaining and len(ranked) < number_takes:
+
+        def key(item: tuple[int, NewsSummary]):
+            index, news = item
+            site = urlsplit(news.url).netloc.removeprefix("www.")
+            score = (
+                dt_weight * news.dt_relevance
+                + personal_weight * news.personal_relevance
+                - source_penalty * taken_per_site.get(site, 0)
+            )
+            return (-score, -news.dt_relevance, index)
+
+        best = min(remaining, key=key)
+        remaining.remove(best)
+        site = urlsplit(best[1].url).netloc.removeprefix("www.")
+        taken_per_site[site] = taken_per_site.get(site, 0) + 1
+        ranked.append(best[1])
+    return ranked
+
+
+@lazy_agent
+def order_news() -> Agent:
+    return Agent(
+        **agent_config("order_news"),
+        description="Returns the top articles by relevance",
+        context={"number_takes": "3", "news_list": ""},
+        instructions=dedent("""\
+            You can find a list of articles scraped by the previous agent in the news_list context.
+            You need to return the top number_takes articles from this list.
+
+            Use the dt_relevance and personal_relevance fields which go from 0 (not relevant) to 10 (very relevant).
+            Of course you should also use the summary field.
+
+            For the final reply, only send the JSON, nothing else. Don't introduce the JSON, just send the json.
+            The result will be parsed with JSON.parse, so don't introduce it in any way.
+            """),
+        response_model=UrlList,
+    )
 
 
 class WeeklyPick(BaseModel):
@@ -83,28 +146,63 @@ class WeeklyPick(BaseModel):
     description: str = Field(..., description="The paragraph for this weekly pick")
 
 
-write_weekly = Agent(
-    **AGENT_CONFIG,
-    description="Write a weekly pick for the article",
-    tools=[FirecrawlTools(crawl=False)],
-    context={"personal_interest": "", "article": ""},
-    instructions=dedent("""\
-        For the URL in the prompt, fetch the website, and create a weekly pick.
-        A weekly pick has the following format:
-        - it is a 1-paragraph, about 500 characters description of the article
-        - take into account the personal interest of the requester
-        - it puts digital trust in the foreground
-        - it should talk about how the problem might be solved
-
-        It should highlight why the article has been chosen, but be written from a neutral point of view.
-        Write in a nice style, not too formal. Use short sentences, and avoid too complicated words.
-        Don't add adverbs and adjectives all over the place.
-
-        For the final reply, only send the JSON, nothing else. Don't introduce the JSON, just send the json.
-        The result will be parsed with JSON.parse, so don't introduce it in any way.
-
-        The personal interest of the user is defined in the personal_interest context.
-        You can find previously summarized information about the article in the article context.
-        """),
-    response_model=WeeklyPick,
-)
+@lazy_agent
+def write_weekly() -> Agent:
+    return Agent(
+        **agent_config("write_weekly"),
+        description="Write a weekly pick for the article",
+        tools=[ScrapeTools(ARTICLE_MAX_TOKENS, keep_links=False)],
+        context={"personal_interest": "", "article": ""},
+        instructions=dedent("""\
+            For the URL in the prompt, fetch the website, and create a weekly pick.
+            A weekly pick has the following format:
+            - it is a 1-paragraph, about 500 characters description of the article
+            - take into account the personal interest of the requester
+            - it puts digital trust in the foreground
+            - it should talk about how the problem might be solved
+
+            It should highlight why the article has been chosen, but be written from a neutral point of view.
+            Write in a nice style, not too formal. Use short sentences, and avoid too complicated words.
+            Don't add adverbs and adjectives all over the place.
+
+            For the final reply, only send the JSON, nothing else. Don't introduce the JSON, just send the json.
+            The result will be parsed with JSON.parse, so don't introduce it in any way.
+
+            The personal interest of the user is defined in the personal_interest context.
+            You can find previously summarized information about the article in the article context.
+            """),
+        response_model=WeeklyPick,
+    )
+
+
+class WeeklyPickList(BaseModel):
+    weekly_picks: list[WeeklyPick]
+
+
+@lazy_agent
+def write_weekly_batch() -> Agent:
+    return Agent(
+        **agent_config("write_weekly_batch"),
+        description="Write the weekly picks for a list of articles",
+        context={"personal_interest": "", "articles": []},
+        instructions=dedent("""\
+            You can find a list of articles in the articles context, with their url, a summary,
+            and the text of the article. Don't visit the articles, only use the text given.
+            For every article, create a weekly pick, and return it with the url unchanged.
+            A weekly pick has the following format:
+            - it is a 1-paragraph, about 500 characters description of the article
+            - take into account the personal interest of the requester
+            - it puts digital trust in the foreground
+            - it should talk about how the problem might be solved
+
+            It should highlight why the article has been chosen, but be written from a neutral point of view.
+            Write in a nice style, not too formal. Use short sentences, and avoid too complicated words.
+            Don't add adverbs and adjectives all over the place.
+
+            For the final reply, only send the JSON, nothing else. Don't introduce the JSON, just send the json.
+            The result will be parsed with JSON.parse, so don't introduce it in any way.
+
+            The personal interest of the user is defined in the personal_interest context.
+            """),
+        response_model=WeeklyPickList,
+    )